@@ -0,0 +1,283 @@
+#=======================================================================
+#       Micro-benchmarks for ptscrape hot paths
+#
+# The startup_* benchmarks time fresh interpreters importing the modules
+# and running a command-line tool, so import-time regressions show up.
+#
+# Each benchmark builds synthetic input of a configurable size and times
+# one operation.  Results are written as JSON and can be compared with
+# a saved baseline; a slowdown beyond the threshold fails the run.
+#
+#   python bench.py --save results.json
+#   python bench.py --baseline results.json --threshold 0.25
+#=======================================================================
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+_log = logging.getLogger(__name__)
+
+BENCHMARKS = []
+
+def benchmark(name):
+    '''Register a benchmark.  The decorated function takes a scale
+    factor and returns the callable to time.'''
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+#-----------------------------------------------------------------------
+#       Synthetic inputs
+#-----------------------------------------------------------------------
+def make_usage_page(rows):
+    '''TG582n broadband page with two datatables of rows rows each'''
+    items = []
+    for title, unit in (('DSL Connection', 'MB/GB'), ('Internet', 'kB/MB')):
+        trs = ['<tr><td>Data Transferred (Sent/Received) [%s]:</td>'
+               '<td>123,45 / 6789,01</td></tr>' % unit]
+        for i in range(rows):
+            trs.append('<tr><td>Label <b>%d</b>:</td><td><span>value %d'
+                       '</span> units</td><td>extra</td></tr>' % (i, i))
+        items.append('<div class="contentitem"><span class="itemtitle">%s'
+                     '</span><table class="datatable">%s</table></div>'
+                     % (title, ''.join(trs)))
+    return ('<html><head><title>TG582n Broadband Connection</title></head>'
+            '<body>%s</body></html>' % ''.join(items))
+
+def make_deep_tree(depth, breadth=3):
+    '''Nested markup depth levels deep with text at every level'''
+    html = 'leaf'
+    for level in range(depth):
+        html = '<div>text %d %s</div>' % (level, (html + ' ') * breadth)
+    return '<html><body>%s</body></html>' % html
+
+def make_grid_table(rows):
+    '''MyRecruiter hours grid with a standard and overtime row per job'''
+    trs = ['<table><tr><th>WBS</th></tr>']
+    for i in range(rows):
+        std, ovt = 2 * i + 1, 2 * i + 2
+        inputs = ['<input type="hidden" name="delete_grid_1" value="">',
+                  '<input type="checkbox" name="delete_grid_1" value="%d">'
+                  % (100 + i),
+                  '<input type="text" name="grid_1_%d_wbs_code" '
+                  'value="%05d.A%04d">' % (std, i, i),
+                  '<input type="text" name="grid_1_%d_title" value="Job %d">'
+                  % (std, i)]
+        inputs += ['<input type="text" name="grid_1_%d_d%d" value="">'
+                   % (std, d) for d in range(1, 8)]
+        inputs += ['<input type="hidden" name="grid_1_%d_wbs_code" value="">'
+                   % ovt,
+                   '<input type="hidden" name="grid_1_%d_title" value="">'
+                   % ovt]
+        inputs += ['<input type="text" name="grid_1_%d_d%d" value="">'
+                   % (ovt, d) for d in range(1, 8)]
+        trs.append('<tr><td>%s</td></tr>' % ''.join(inputs))
+    trs.append('</table>')
+    return ''.join(trs)
+
+def make_tasklog(entries, jobs=50):
+    '''Tasklog XML for one week with entries time records'''
+    rnd = random.Random(1)
+    lines = ['<?xml version="1.0"?>', '<timesheet>', ' <name>Bench</name>',
+             ' <company>Bench Ltd</company>', '<week enddate="2014-03-08">']
+    for i in range(entries):
+        day = rnd.randrange(7)
+        lines.append('<time jobcode="J%03d" date="2014-03-%02d"%s hours="%.2f"/>'
+                     % (rnd.randrange(jobs), 2 + day,
+                        ' weekend="1"' if day in (0, 6) else '',
+                        rnd.uniform(0.1, 3)))
+    for day in range(7):
+        lines.append('<allowance date="2014-03-%02d" code="ABP" quantity="1"/>'
+                     % (2 + day))
+    lines += ['</week>', '</timesheet>']
+    return '\n'.join(lines)
+
+#-----------------------------------------------------------------------
+#       Benchmarks
+#-----------------------------------------------------------------------
+@benchmark('replay_get_parse')
+def bench_replay(scale):
+    from ptscrape import PageSource
+    cachedir = tempfile.mkdtemp(prefix='ptbench')
+    _cleanup.append(cachedir)
+    url = 'http://modem/cgi/b/bb/'
+    recorder = PageSource(cachedir=cachedir)
+    recorder.write_cache(recorder.cache.key('GET', url, None, 'bb'),
+                         make_usage_page(50 * scale), method='GET', url=url)
+    recorder.close()
+    source = PageSource(cachedir=cachedir, replay=True)
+    return lambda: source.get(url, tag='bb').doc
+
+@benchmark('bs_cdata_deep')
+def bench_bs_cdata(scale):
+    from ptscrape import parse, bs_cdata
+    doc = parse(make_deep_tree(6 + scale))
+    return lambda: bs_cdata(doc)
+
+@benchmark('broadband_usage')
+def bench_usage(scale):
+    from ptscrape import Page
+    from tg582n import Modem
+    page = Page('http://modem/', make_usage_page(200 * scale))
+    page.doc
+    modem = Modem.__new__(Modem)
+    return lambda: modem.get_broadband_usage(page)
+
+@benchmark('parse_hours_table')
+def bench_hours(scale):
+    from ptscrape import parse
+    from myrec import MyRec
+    table = parse(make_grid_table(100 * scale)).find('table')
+    rec = MyRec.__new__(MyRec)
+    return lambda: rec.parse_hours_table(table)
+
+@benchmark('tasklog_xml')
+def bench_tasklog(scale):
+    from myrec import Timesheet
+    xml = make_tasklog(500 * scale)
+    return lambda: Timesheet.from_tasklog_xml(xml)
+
+@benchmark('tasklog_iterparse')
+def bench_tasklog_iter(scale):
+    from cStringIO import StringIO
+    from myrec import Timesheet
+    xml = make_tasklog(500 * scale)
+    return lambda: list(Timesheet.iter_tasklog_xml(StringIO(xml)))
+
+@benchmark('round_dict')
+def bench_round_dict(scale):
+    from myrec import round_dict
+    rnd = random.Random(2)
+    d = dict(('K%05d' % i, rnd.uniform(0, 8)) for i in range(1000 * scale))
+    return lambda: round_dict(d, 0.25)
+
+@benchmark('quarterise_many')
+def bench_quarterise(scale):
+    from myrec import Timesheet, quarterise_many
+    xml = make_tasklog(100)
+    sheets = [Timesheet.from_tasklog_xml(xml) for i in range(50 * scale)]
+    return lambda: quarterise_many(sheets)
+
+@benchmark('txrx_gb')
+def bench_txrx(scale):
+    from tg582n import txrx_gb
+    label = 'Data Transferred (Sent/Received) [MB/GB]:'
+    return lambda: txrx_gb(label, '123,45 / 6789,01')
+
+@benchmark('startup_bare')
+def bench_startup_bare(scale):
+    return _spawn(['-c', 'pass'])
+
+@benchmark('startup_import')
+def bench_startup_import(scale):
+    return _spawn(['-c', 'import tg582n, myrec'])
+
+@benchmark('startup_cli_help')
+def bench_startup_help(scale):
+    return _spawn([os.path.join(_here, 'tg582n.py'), '--help'])
+
+def _spawn(args):
+    '''Run a fresh interpreter in this directory, for startup times'''
+    import subprocess
+    devnull = open(os.devnull, 'w')
+    _cleanup.append(devnull)
+    def run():
+        subprocess.check_call([sys.executable] + args, cwd=_here,
+                              stdout=devnull, stderr=devnull)
+    return run
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_cleanup = []
+
+#-----------------------------------------------------------------------
+#       Running and comparison
+#-----------------------------------------------------------------------
+def run(names=None, scale=1, repeat=5, min_time=0.2):
+    '''Time the selected benchmarks.
+    Return dict of name -> {'seconds': best time per call, 'number': calls}
+    '''
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        func = setup(scale)
+        timer = timeit.Timer(func)
+        # Calibrate so that each repeat takes at least min_time
+        number = 1
+        while timer.timeit(number) < min_time and number < 10**6:
+            number *= 10
+        best = min(timer.repeat(repeat, number)) / number
+        results[name] = dict(seconds=best, number=number)
+        _log.info('%s: %.3g s', name, best)
+    return results
+
+def compare(results, baseline, threshold):
+    '''Return list of (name, seconds, baseline seconds or None, ratio,
+    regressed) for each result'''
+    rows = []
+    for name in sorted(results):
+        t = results[name]['seconds']
+        base = baseline.get(name, {}).get('seconds')
+        ratio = t / base if base else None
+        regressed = ratio is not None and ratio > 1 + threshold
+        rows.append((name, t, base, ratio, regressed))
+    return rows
+
+def main(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser(description='ptscrape micro-benchmarks')
+    ap.add_argument('--verbose', '-v', action='store_true')
+    ap.add_argument('--scale', type=int, default=1,
+                    help='Multiply the size of the synthetic inputs')
+    ap.add_argument('--repeat', type=int, default=5)
+    ap.add_argument('--save', metavar='FILE',
+                    help='Write results to this JSON file')
+    ap.add_argument('--baseline', metavar='FILE',
+                    help='Compare with results saved earlier')
+    ap.add_argument('--threshold', type=float, default=0.25,
+                    help='Fractional slowdown counted as a regression')
+    ap.add_argument('name', nargs='*',
+                    help='Benchmarks to run; default all of %s'
+                    % ', '.join(n for n, s in BENCHMARKS))
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    try:
+        results = run(args.name, args.scale, args.repeat)
+    finally:
+        for d in _cleanup:
+            if isinstance(d, file):
+                d.close()
+            else:
+                shutil.rmtree(d, ignore_errors=True)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    rows = compare(results, baseline, args.threshold)
+    print '%-20s %12s %12s %8s' % ('benchmark', 'seconds', 'baseline', 'ratio')
+    for name, t, base, ratio, regressed in rows:
+        print '%-20s %12.3g %12s %8s%s' % (
+            name, t, '-' if base is None else '%.3g' % base,
+            '-' if ratio is None else '%.2f' % ratio,
+            '  REGRESSION' if regressed else '')
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(meta=dict(python=platform.python_version(),
+                                     platform=platform.platform(),
+                                     scale=args.scale,
+                                     time=time.strftime('%Y-%m-%dT%H:%M:%S')),
+                           results=results),
+                      f, indent=1, sort_keys=True)
+    return 1 if any(row[-1] for row in rows) else 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -19,7 +19,8 @@
 #   create query to fill grids
 #   post update to save as draft
 #=======================================================================
-from ptscrape import PageSource, soup, bs_cdata
+from ptscrape import PageSource, TableSchema, Form, Metrics, ExtractCache, \
+     extractor, page_title, parse, bs_cdata
 from urlparse import urljoin
 import datetime
 import re
@@ -32,48 +33,95 @@ class MyRec(object):
     '''Tool for submitting timesheets to Rullion MyRecruiter'''
 
     siteurl = 'https://ssl.rullionsolutions.com'
-
-    def __init__(self, org, authfile, cachedir='~/var/myrec', replay=False):
+    # Parts of pages we read; the rest is not parsed
+    home_regions = ['li#task_menu']
+    timesheet_regions = ['div#grid_1', 'div#grid_2', 'p.error']
+    # id and val of the first <span> in each allowance row
+    allowance_schema = TableSchema(cell=None,
+                                   attrs=[('span', 'id'), ('span', 'val')])
+
+    def __init__(self, org, authfile, cachedir='~/var/myrec', replay=False,
+                 sessionfile=None, metrics=None, memo=None):
         '''
         :param org: First segment of site URL path
         :param authfile: File containing username:password
         :param cachedir: Folder to hold saved web pages
         :param replay: If True, read from cachedir instead of web site
+        :param sessionfile: File to keep the login session in between runs
+        :param metrics: Collector for request timings; see ptscrape.Metrics
+        :param memo: ptscrape.ExtractCache to skip parsing unchanged pages
         '''
         self.org = org
         self.wbs_titles = {}
+        # Per-run memo, so no page is fetched twice
+        self._tslinks = None
+        self.pages = {}         # timesheet href -> Page
         self.baseurl = '%s/%s/' % (self.siteurl, org)
         with open(os.path.expanduser(authfile)) as f:
             self.user, self.password = f.readline().rstrip().split(':')
-        self.source = PageSource(cachedir=cachedir, replay=replay)
+        self.source = PageSource(cachedir=cachedir, replay=replay,
+                                 session=sessionfile, metrics=metrics,
+                                 memo=memo)
 
     def login(self):
-        '''Log in to MyRecuiter using credentials from the authfile'''
+        '''Log in to MyRecuiter using credentials from the authfile,
+        unless a stored session still gets us the Resources page'''
+        if self.source.session_valid():
+            home = self.source.get(self.baseurl+'main/',
+                                   tag='home', only=self.home_regions)
+            if page_title(home) == u'Resources':
+                self.source.mark_session_valid()
+                return home
+            _log.info('session expired, logging in')
+            self.source.invalidate_session()
         # Get the main page, setting a session cookie.  (Is it necessary?)
         main = self.source.get(self.baseurl+'main/',
-                               tag='main')
-        assert main.find('title').text == u'Login'
+                               tag='main', only=[])
+        assert page_title(main) == u'Login'
         # Post login credentials
         query = {
             'j_username': self.user,
             'j_password': self.password,
             }
         check = self.source.post(self.baseurl+'j_security_check', query,
-                                 tag='check')
+                                 tag='check', only=[])
         #assert check.find('title').text == u'Resources'
         # Fetch the login page.  If login failed, we won't see Resources
         home = self.source.get(self.baseurl+'main/',
-                               tag='home')
-        assert home.find('title').text == u'Resources'
+                               tag='home', only=self.home_regions)
+        assert page_title(home) == u'Resources'
+        self.source.mark_session_valid()
         # The menu will have pending timesheet tasks
         return home
 
     def timesheet(self, href):
         '''Get a timesheet update page'''
-        tsurl = urljoin(self.baseurl+'main/', href)
-        ts = self.source.get(tsurl, tag='ts')
-        assert ts.find('title').text.startswith(u'Update this Timesheet')
-        return ts
+        if href not in self.pages:
+            tsurl = urljoin(self.baseurl+'main/', href)
+            ts = self.source.get(tsurl, tag='ts', only=self.timesheet_regions)
+            self._check_timesheet(ts)
+            self.pages[href] = ts
+        return self.pages[href]
+
+    def _check_timesheet(self, ts):
+        assert page_title(ts).startswith(u'Update this Timesheet')
+
+    def fetch_timesheets(self, dates, workers=4):
+        '''Fetch the pages of several pending timesheets concurrently'''
+        tslinks = self.get_timesheet_links()
+        hrefs = {}
+        for date in dates:
+            if date not in tslinks:
+                raise KeyError('No timesheet for %s' % date)
+            href = tslinks[date]
+            if href not in self.pages:
+                hrefs[urljoin(self.baseurl+'main/', href)] = href
+        urls = sorted(hrefs)
+        for ts in self.source.get_many(urls, ['ts'] * len(urls), workers,
+                                       only=self.timesheet_regions):
+            self._check_timesheet(ts)
+            self.pages[hrefs[ts.url]] = ts
+        return dict((date, self.pages[tslinks[date]]) for date in dates)
 
     def add_timesheet_rows(self, href, count):
         '''Post a request for a new timesheet with more rows
@@ -87,10 +135,13 @@ class MyRec(object):
             'page_button': 'add_row_grid_1',
             'add_row_number_grid_1': str(count),
             }
-        ts = self.source.post(tsurl, query, tag='tsrows')
+        ts = self.source.post(tsurl, query, tag='tsrows',
+                              only=self.timesheet_regions)
+        self.pages[href] = ts
         return ts
 
-    def parse_timesheet(self, doc):
+    @extractor('myrec.parse_timesheet')
+    def parse_timesheet(self, page):
         '''
         <div id='grid_1'>
          <div ...>
@@ -99,9 +150,10 @@ class MyRec(object):
 
         Return (hrows, arows)
         '''
-        err = doc.find('p', {'class': lambda c: 'error' in c.split()})
+        doc = page.doc
+        err = doc.find('p', {'class': 'error'})
         if err:
-            raise Exception('ERROR: %s' % cdata(err))
+            raise Exception('ERROR: %s' % bs_cdata(err))
         grid1 = doc.find('div', id='grid_1')
         if not grid1:
             raise ValueError('div#grid_1 not found')
@@ -141,21 +193,22 @@ class MyRec(object):
         return dict of wbs -> [stdrow,ovtrow,deltag]
         rows['22614.A0110'] = ['1','2','23']
         '''
+        form = Form.from_element(table)
+        # One delete checkbox per standard row, in document order
+        deltags = [f.value for f in form.index.get('delete_grid_1', [])
+                   if f.type == 'checkbox']
+        grid = form.group(r'(grid_1_\d+)_(\w+)')
         rows = {}
         wbs = None
-        deltag = None
-        for inp in table.findAll('input'):
-            type = inp['type']
-            name = inp['name']
-            if name == 'delete_grid_1' and type == 'checkbox':
-                deltag = inp['value']
-            elif re.match(r'grid_1_\d+_wbs_code', name):
-                if type == 'text':
-                    wbs = inp['value']
-                    rows[wbs] = [None, None, deltag]
-                    rows[wbs][0] = name[:-9]
-                elif type == 'hidden':
-                    rows[wbs][1] = name[:-9]
+        for prefix in sorted(grid, key=lambda p: int(p.rsplit('_', 1)[1])):
+            field = grid[prefix].get('wbs_code')
+            if field is None:
+                continue
+            if field.type == 'text':
+                wbs = field.value
+                rows[wbs] = [prefix, None, deltags.pop(0) if deltags else None]
+            elif field.type == 'hidden' and wbs is not None:
+                rows[wbs][1] = prefix
         return rows
 
     def parse_allowance_table(self, table):
@@ -168,21 +221,27 @@ class MyRec(object):
         </tr>
         '''
         rows = {}
-        for tr in table.findAll('tr'):
-            span = tr.find('span')
-            if not span:
+        title, trs = self.allowance_schema.extract(table)[0]
+        for id, val in trs:
+            if not id:
                 # Probably header
-                # print tr
                 continue
-            id = span['id']
             if re.match(r'grid_2_\d+_rate_code', id):
-                rows[span['val']] = id[:-10]
+                rows[val] = id[:-10]
         return rows
 
     def get_timesheet_links(self):
-        doc = self.login()
-        # Identify pending timesheets in the task menu
-        menu = doc.find('li', {'id':'task_menu'})
+        '''Map end date -> href of each pending timesheet, logging in the
+        first time it is called'''
+        if self._tslinks is not None:
+            return self._tslinks
+        self._tslinks = self.parse_timesheet_links(self.login())
+        return self._tslinks
+
+    @extractor('myrec.timesheet_links')
+    def parse_timesheet_links(self, home):
+        '''Identify pending timesheets in the task menu of the home page'''
+        menu = home.doc.find('li', {'id':'task_menu'})
         tslinks = {}
         for a in menu.findAll('a', {'href': lambda h:'/ts_tmsht_update' in h}):
             m = re.search(r' - (\d\d)/(\d\d)/(\d\d)\)', a.text)
@@ -192,17 +251,58 @@ class MyRec(object):
         return tslinks
 
     def get_timesheet(self, date):
-        tslinks = rec.get_timesheet_links()
+        tslinks = self.get_timesheet_links()
         if date not in tslinks:
             raise KeyError('No timesheet for %s' % date)
-        link = tslinks[args.date]
+        link = tslinks[date]
         ts = self.timesheet(link)
         return link, ts
 
-    def timesheet_query(self, timesheet, hrows, arows):
+    def batch_queries(self, timesheets, rows=1, workers=4):
+        '''Build the submissions for several timesheets over one login.
+        Pages are fetched concurrently; rows are added where a timesheet
+        has more jobs than the page has rows.
+        :param timesheets: Timesheet objects, matched to pending
+            timesheets by end date.  Those for weeks which are not
+            pending are skipped with a warning; two for one week are an
+            error.
+        :param rows: Minimum number of hours rows on each page
+        Return dict of date -> (href, query)
+        '''
+        tslinks = self.get_timesheet_links()
+        bydate = {}
+        for ts in timesheets:
+            date = str(ts.enddate)
+            if date in bydate:
+                raise ValueError('Several timesheets for %s' % date)
+            bydate[date] = ts
+        for date in sorted(set(bydate) - set(tslinks)):
+            _log.warning('No pending timesheet for %s, skipped', date)
+            del bydate[date]
+        self.fetch_timesheets(sorted(bydate), workers)
+        results = {}
+        for date, timesheet in sorted(bydate.items()):
+            href = tslinks[date]
+            page = self.pages[href]
+            hrows, arows = self.parse_timesheet(page)
+            need = max(rows, len(timesheet.wbs_list()))
+            if len(hrows) < need:
+                page = self.add_timesheet_rows(href, need - len(hrows))
+                hrows, arows = self.parse_timesheet(page)
+            results[date] = (href, self.timesheet_query(
+                timesheet, hrows, arows, self.timesheet_form(page)))
+        return results
+
+    def timesheet_form(self, page):
+        '''Form of the hours and allowance grids of a timesheet page'''
+        return Form.from_element(page.doc)
+
+    def timesheet_query(self, timesheet, hrows, arows, form):
         '''Create a query for the submission of a timesheet.
         timesheet contains hours and allowances.
         hrows and arows contain mappings from WBS/allowance codes to row ids.
+        form is the timesheet_form() of the page; fields which are not
+        set here are submitted with their current values.
         '''
         query = []
         wbss = timesheet.wbs_list()
@@ -246,13 +346,15 @@ class MyRec(object):
         # Delete any extra hours rows
         for hrow in hrows.values()[nwbs:]:
             query.append(('delete_grid_1', hrow[0]))
-        return query
+        return form.query(query)
         
 class Timesheet:
     '''Model of a timesheet for a single week
       enddate     YYYY-MM-DD or None
       jobs        dict, key=WBS, value=7-element list of (std,ovt) hours
       allowances  dict, key=code, value=7-element list of 1|0
+    matrix() gives the hours as an array for vectorised work, and
+    quarterise_many() rounds many timesheets together.
     '''
     def __init__(self, enddate=None):
         if isinstance(enddate, (str, unicode)):
@@ -320,32 +422,111 @@ class Timesheet:
     def wbs_list(self):
         return sorted(self.jobs.keys())
 
+    def matrix(self):
+        '''Hours as a numpy array indexed [job, STD/OVT, day], with the
+        jobs in wbs_list() order.
+        Return (wbs list, array)'''
+        import numpy as np
+        wbs = self.wbs_list()
+        hours = np.zeros((len(wbs), 2, 7))
+        for i, code in enumerate(wbs):
+            hours[i] = self.jobs[code]
+        return wbs, hours
+
+    def set_matrix(self, wbs, hours):
+        '''Replace the hours for each WBS code in wbs from an array as
+        returned by matrix()'''
+        for code, job in zip(wbs, hours):
+            self.jobs[code] = [list(job[0]), list(job[1])]
+
+    def totals(self):
+        '''Hours for the week by WBS code.
+        Return (wbs list, numpy array indexed [job, STD/OVT])'''
+        wbs, hours = self.matrix()
+        return wbs, hours.sum(axis=2)
+
     @classmethod
-    def from_tasklog_xml_file(cls, filename):
+    def from_tasklog_xml_file(cls, filename, parser='xml'):
         with open(filename) as f:
             xml = f.read()
-        return cls.from_tasklog_xml(xml)
+        return cls.from_tasklog_xml(xml, parser)
+
+    # Tasklog allowance code -> MyRecruiter rate code
+    code_map = dict(ABP='SCM',
+                    ABR='SCW',
+                    ALH='MES')
 
     @classmethod
-    def from_tasklog_xml(cls, xml):
-        code_map = dict(ABP='SCM',
-                        ABR='SCW',
-                        ALH='MES')
+    def from_tasklog_xml(cls, xml, parser='xml'):
+        '''
+        :param parser: bs4 tree builder for the XML; see ptscrape.parse
+        '''
         self = cls()
-        doc = soup.BeautifulSoup(xml, features='xml')
+        doc = parse(xml, parser)
         self.name = bs_cdata(doc.find('name'))
         self.company = bs_cdata(doc.find('company'))
         week = doc.find('week')
-        enddate = week['enddate']
+        self._load_tasklog_week(week['enddate'],
+                                [dict(t.attrs) for t in week.findAll('time')],
+                                [dict(a.attrs)
+                                 for a in week.findAll('allowance')])
+        return self
+
+    @classmethod
+    def iter_tasklog_xml(cls, source):
+        '''Yield a Timesheet for each <week> in a tasklog XML file.
+        An archive may hold many weeks, in several <timesheet> elements
+        for different people.  The file is parsed incrementally and each
+        week discarded once read, so memory use does not grow with it.
+        :param source: Filename or file object
+        '''
+        try:
+            from lxml.etree import iterparse
+        except ImportError:
+            from xml.etree.cElementTree import iterparse
+        name = company = None
+        path = []
+        for event, elem in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'timesheet':
+                    name = company = None
+                path.append(elem)
+                continue
+            path.pop()
+            if any(e.tag == 'week' for e in path):
+                # Needed until the end of its week
+                continue
+            if elem.tag == 'name':
+                name = ''.join(elem.itertext())
+            elif elem.tag == 'company':
+                company = ''.join(elem.itertext())
+            elif elem.tag == 'week':
+                self = cls()
+                self.name = name
+                self.company = company
+                self._load_tasklog_week(
+                    elem.get('enddate'),
+                    [t.attrib for t in elem.iter('time')],
+                    [a.attrib for a in elem.iter('allowance')])
+                yield self
+            elem.clear()
+            if path:
+                # Drop earlier siblings, but keep this one, as lxml would
+                # append the text that follows it to its parent instead
+                del path[-1][:-1]
+
+    def _load_tasklog_week(self, enddate, times, allowances):
+        '''Add hours and allowances from the attributes of the <time> and
+        <allowance> elements of a tasklog <week>'''
         self.set_enddate(enddate)
-        for time in week.findAll('time'):
+        for time in times:
             wbs = time['jobcode']
             date = time['date']
             hours = time['hours']
             weekend = time.get('weekend','')
             self.add_hours(date, wbs, float(hours), 'OVT' if weekend else 'STD')
         alday = 1
-        for allowance in week.findAll('allowance'):
+        for allowance in allowances:
             code = allowance['code']
             quantity = allowance['quantity']
             date = allowance.get('date','')
@@ -353,8 +534,7 @@ class Timesheet:
                 # Old tasklog did not tag allowance with date
                 alday += 1
                 date = date_shift(self.enddate, -7 + alday)
-            self.add_allowance(date, code_map[code], float(quantity))
-        return self
+            self.add_allowance(date, self.code_map[code], float(quantity))
 
     def write_tasklog_xml(self, filename):
         '''Regenerate XML file from adjusted values
@@ -413,21 +593,37 @@ class Timesheet:
         '''Fudge times to be round quarter-hours
         :param itype: 0 for standard hours, 1 for overtime
         '''
-        total = 0.0
-        by_wbs = {}
-        for wbs,stdovt in self.jobs.items():
-            wbstot = sum(stdovt[itype])
-            by_wbs[wbs] = wbstot
-            total += wbstot
-        fix_wbs = round_dict(by_wbs, 0.25)
-        _log.debug('round', str(fix_wbs))
-        for wbs, stdovt in self.jobs.items():
-            by_day = {}
-            for d in range(7):
-                by_day[d] = stdovt[itype][d]
-            fix_day = round_dict(by_day, 0.25, fix_wbs[wbs])
-            for d in range(7):
-                self.jobs[wbs][itype][d] = fix_day[d]
+        quarterise_many([self], itype)
+
+def quarterise_many(timesheets, itype=0, quantum=0.25):
+    '''Round the hours of many timesheets at once to multiples of quantum.
+    In each timesheet the total per WBS code is rounded so that the week's
+    total rounds up, then each day is rounded to keep that WBS total, as
+    round_dict() would do.
+    :param itype: 0 for standard hours, 1 for overtime
+    '''
+    import numpy as np
+    matrices = [ts.matrix() for ts in timesheets]
+    counts = [len(wbs) for wbs, hours in matrices]
+    if not sum(counts):
+        return
+    # Totals per WBS code, one padded row per timesheet
+    width = max(counts)
+    by_wbs = np.zeros((len(matrices), width))
+    mask = np.zeros((len(matrices), width), bool)
+    for row, (wbs, hours) in enumerate(matrices):
+        by_wbs[row, :len(wbs)] = hours[:, itype].sum(axis=1)
+        mask[row, :len(wbs)] = True
+    fix_wbs = round_rows(by_wbs, quantum, mask=mask)[mask]
+    # Then days, one row per WBS code of every timesheet
+    days = np.concatenate([hours[:, itype] for wbs, hours in matrices
+                           if len(wbs)])
+    fixed = round_rows(days, quantum, fix_wbs)
+    start = 0
+    for ts, (wbs, hours), n in zip(timesheets, matrices, counts):
+        hours[:, itype] = fixed[start:start + n]
+        ts.set_matrix(wbs, hours)
+        start += n
 
 def round_dict(d, quantum, target=None):
     '''Round values in a dict to be multiples of a quantum.
@@ -470,6 +666,43 @@ def round_dict(d, quantum, target=None):
         adj[k] = u * quantum
     return adj
 
+def round_rows(values, quantum, targets=None, mask=None):
+    '''Vectorised round_dict() over the rows of a 2-d numpy array.
+    Each row is rounded to multiples of quantum by largest remainder,
+    so that its total matches the row's target, else is rounded up.
+    :param targets: Array of row totals to keep, or None
+    :param mask: Boolean array marking the values in use, for rows of
+        different lengths; other values are left alone
+    Return the rounded array.
+    '''
+    import numpy as np
+    values = np.asarray(values, float)
+    if mask is None:
+        mask = np.ones(values.shape, bool)
+    scaled = np.where(mask, values / quantum, 0.0)
+    # Halves away from zero, like quanta()
+    units = np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)
+    diff = np.where(mask, values - units * quantum, 0.0)
+    if targets is None:
+        # Allow for summation error, so an exact multiple stays put
+        total = np.where(mask, values, 0.0).sum(axis=1)
+        utarget = np.ceil(total / quantum - 1e-9)
+    else:
+        scaled = np.asarray(targets, float) / quantum
+        utarget = np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)
+    need = utarget - units.sum(axis=1)
+    rows = np.arange(len(values))[:, None]
+    # Rank each value by remainder, largest first for rounding up and
+    # smallest first for rounding down; unused values rank last
+    for sign, keys in ((1, -diff), (-1, diff)):
+        keys = np.where(mask, keys, np.inf)
+        order = np.argsort(keys, axis=1, kind='mergesort')
+        rank = np.empty_like(order)
+        rank[rows, order] = np.arange(values.shape[1])
+        adjust = mask & (rank < (sign * need)[:, None])
+        units += sign * adjust
+    return np.where(mask, units * quantum, values)
+
 def quanta(value, quantum):
     '''Integer for which value is the nearest multiple'''
     return int(round(value / quantum))
@@ -477,6 +710,12 @@ def quanta(value, quantum):
 def date_from_iso(isodate):
     return datetime.date(*[int(d) for d in isodate.split('-')])
 
+def date_shift(date, days):
+    '''Date the given number of days after date'''
+    if isinstance(date, (str, unicode)):
+        date = date_from_iso(date)
+    return date + datetime.timedelta(days=days)
+
 if __name__=='__main__':
     def last_saturday():
         today = datetime.date.today()
@@ -488,13 +727,28 @@ if __name__=='__main__':
     import logging
     ap = argparse.ArgumentParser()
     ap.add_argument('--replay', action='store_true')
+    ap.add_argument('--session', default='~/var/myrec/session')
     ap.add_argument('--date', default=last_saturday())
     ap.add_argument('--rows', type=int, default=1)
     ap.add_argument('--timesheet', type=str)
+    ap.add_argument('--tasklog', action='append', default=[],
+                    help='Tasklog XML file or archive for batch;'
+                    ' may be repeated')
+    ap.add_argument('--name',
+                    help='Person whose weeks batch submits; needed when'
+                    ' the tasklogs have weeks for several people')
+    ap.add_argument('--metrics', metavar='FILE',
+                    help='Write request timing metrics to FILE on exit')
+    ap.add_argument('--memo', metavar='FILE',
+                    help='Keep extracted data in FILE, to skip parsing'
+                    ' pages seen before')
     ap.add_argument('action')
     args = ap.parse_args()
     logging.basicConfig(level=logging.INFO)
-    rec = MyRec('ccfe_prod', '~/.rullion.auth', replay=args.replay)
+    metrics = Metrics() if args.metrics else None
+    rec = MyRec('ccfe_prod', '~/.rullion.auth', replay=args.replay,
+                sessionfile=args.session, metrics=metrics,
+                memo=ExtractCache(args.memo) if args.memo else None)
 
     if args.action == 'login':
         rec.login()
@@ -525,8 +779,37 @@ if __name__=='__main__':
         hrows, arows = rec.parse_timesheet(tspage)
         #print 'hrows',hrows
         #print 'arows',arows
-        query = rec.timesheet_query(ts, hrows, arows)
+        query = rec.timesheet_query(ts, hrows, arows,
+                                    rec.timesheet_form(tspage))
         for n,v in sorted(query):
             print n,v
+    elif args.action == 'batch':
+        # Archives hold past weeks too; submit only the pending ones
+        pending = rec.get_timesheet_links()
+        name = args.name and args.name.decode('utf-8')
+        timesheets = []
+        skipped = 0
+        for f in args.tasklog:
+            for ts in Timesheet.iter_tasklog_xml(f):
+                if name and ts.name != name:
+                    continue
+                if str(ts.enddate) in pending:
+                    timesheets.append(ts)
+                else:
+                    skipped += 1
+        names = set(ts.name for ts in timesheets)
+        if len(names) > 1:
+            ap.error('tasklogs have pending weeks for %s; choose one with'
+                     ' --name' % ', '.join(sorted(map(unicode, names))))
+        _log.info('%d pending weeks, %d others skipped',
+                  len(timesheets), skipped)
+        results = rec.batch_queries(timesheets, args.rows)
+        for date, (href, query) in sorted(results.items()):
+            print '#', date, href
+            for n,v in sorted(query):
+                print n,v
     else:
         raise ValueError('Unknown action %r' % args.action)
+    if metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.dump())
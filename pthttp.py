@@ -0,0 +1,400 @@
+#=======================================================================
+#       HTTP transport for ptscrape
+#
+# Pooled keep-alive connections for urllib2, and the Scheduler which
+# applies per-host rate limits, retries and circuit breakers.  Kept apart
+# from ptscrape so that replaying or parsing pages never loads urllib2.
+#=======================================================================
+import errno
+import httplib
+import logging
+import random
+import select
+import socket
+import threading
+import time
+import urllib2
+from urlparse import urlparse
+
+_log = logging.getLogger(__name__)
+
+class ConnectionPool(object):
+    '''Idle HTTP/1.1 connections kept open for reuse, keyed by (scheme, host)'''
+
+    def __init__(self, max_per_host=4, idle_timeout=60.0):
+        '''
+        :param max_per_host: Maximum idle connections kept per host
+        :param idle_timeout: Seconds before an idle connection is discarded
+        '''
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}             # key -> [(conn, released_at)]
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+
+    def acquire(self, key):
+        '''Take an idle connection for key, or None if there is none'''
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if (now - released_at <= self.idle_timeout
+                    and not _dropped(conn)):
+                    self.reused += 1
+                    return conn
+                conn.close()
+        return None
+
+    def release(self, key, conn):
+        '''Return a connection whose response has been fully read'''
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        '''A connection acquired from the pool turned out to be stale'''
+        with self._lock:
+            self.reused -= 1
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, released_at in conns:
+                conn.close()
+
+    def stats(self):
+        '''Request count, connection reuse and idle connections'''
+        with self._lock:
+            return dict(requests=self.requests,
+                        reused=self.reused,
+                        reuse_ratio=(float(self.reused) / self.requests
+                                     if self.requests else 0.0),
+                        idle=sum(len(c) for c in self._idle.values()))
+
+def _dropped(conn):
+    '''Whether the server has closed an idle connection.  An idle socket
+    only becomes readable at EOF, or if the server sent something
+    unasked, and neither leaves it fit for another request.'''
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class KeepAliveHandler(urllib2.AbstractHTTPHandler):
+    '''urllib2 handler which takes HTTP and HTTPS connections from a pool.
+    urllib2 forces "Connection: close" on every request; this handler
+    leaves the connection open and hands it back to the pool once the
+    response body has been read to the end.
+    '''
+    handler_order = urllib2.HTTPHandler.handler_order - 1
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.AbstractHTTPHandler.__init__(self, debuglevel)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self._open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open(httplib.HTTPSConnection, req)
+
+    http_request = urllib2.AbstractHTTPHandler.do_request_
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+    def _open(self, conn_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((k.title(), v) for k, v in headers.items())
+        conn = self.pool.acquire(key)
+        connect = None
+        if conn is not None:
+            start = time.time()
+            try:
+                resp = self._request(conn, req, headers, reused=True)
+            except _StaleConnection:
+                # Server closed the idle connection; retry on a fresh one
+                _log.debug('stale connection to %s', host)
+                self.pool.discard(conn)
+                conn = None
+            except socket.error, err:
+                self.pool.discard(conn)
+                raise urllib2.URLError(err)
+            except httplib.HTTPException:
+                self.pool.discard(conn)
+                raise
+        if conn is None:
+            conn = conn_class(host, timeout=req.timeout)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                start = time.time()
+                conn.connect()
+                connect = time.time() - start
+                start = time.time()
+                resp = self._request(conn, req, headers)
+            except socket.error, err:
+                conn.close()
+                raise urllib2.URLError(err)
+        ttfb = time.time() - start
+        body = _PooledBody(self.pool, key, conn, resp)
+        fp = socket._fileobject(body, close=True)
+        result = urllib2.addinfourl(fp, resp.msg, req.get_full_url())
+        result.code = resp.status
+        result.msg = resp.reason
+        # Seconds to connect (None for a reused connection) and from
+        # sending the request to reading the response headers
+        result.timings = (connect, ttfb)
+        return result
+
+    def _request(self, conn, req, headers, reused=False):
+        '''Send a request and read the response headers.
+        Raise _StaleConnection if a reused connection turns out to have
+        been closed by the server, and the request is safe to send again:
+        either it could not be written, or it is idempotent and the
+        server closed the connection without any response.  Timeouts
+        are never retried.
+        '''
+        method = req.get_method()
+        try:
+            conn.request(method, req.get_selector(), req.data, headers)
+        except socket.error, err:
+            if reused and _closed_by_peer(err):
+                raise _StaleConnection(err)
+            raise
+        try:
+            return conn.getresponse(buffering=True)
+        except httplib.BadStatusLine, err:
+            if reused and method in IDEMPOTENT_METHODS:
+                raise _StaleConnection(err)
+            raise
+        except socket.error, err:
+            if (reused and method in IDEMPOTENT_METHODS
+                and _closed_by_peer(err)):
+                raise _StaleConnection(err)
+            raise
+
+# Requests which may be repeated without changing their effect
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT',
+                                'DELETE'))
+
+class _StaleConnection(Exception):
+    '''A pooled connection was closed by the server while idle'''
+
+def _closed_by_peer(err):
+    return (not isinstance(err, socket.timeout)
+            and err.errno in (errno.ECONNRESET, errno.EPIPE,
+                              errno.ECONNABORTED))
+
+class _PooledBody(object):
+    '''Response body which returns its connection to the pool at EOF'''
+
+    def __init__(self, pool, key, conn, resp):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+    def read(self, amt=None):
+        if self._resp is None:
+            return ''
+        data = self._resp.read(amt)
+        if not data or self._resp.isclosed():
+            self._finish()
+        return data
+
+    recv = read
+
+    def _finish(self):
+        resp, self._resp = self._resp, None
+        if resp.isclosed() and not resp.will_close:
+            self._pool.release(self._key, self._conn)
+        else:
+            self._conn.close()
+
+    def close(self):
+        if self._resp is not None:
+            # Body not read to the end, so the connection cannot be reused
+            self._resp = None
+            self._conn.close()
+
+class CircuitOpenError(urllib2.URLError):
+    '''Request refused without trying, as its host keeps failing'''
+
+class Scheduler(object):
+    '''Per-host request policy for PageSource: a token-bucket rate limit,
+    bounded retries of idempotent requests with exponential backoff and
+    jitter, and a circuit breaker which fails requests fast once a host
+    has failed several times in a row.
+    '''
+    # HTTP statuses worth retrying; others are the server's final answer
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate=None, burst=1, retries=2, backoff=0.5,
+                 max_backoff=30.0, failures=5, reset_timeout=60.0):
+        '''
+        :param rate: Requests per second allowed to each host, or None
+            for no limit
+        :param burst: Requests a host may get at once after being idle
+        :param retries: Extra attempts for a failed idempotent request
+        :param backoff: Seconds before the first retry; doubled for each
+            later one, with the actual delay chosen at random up to that
+        :param max_backoff: Longest delay before a retry
+        :param failures: Consecutive failures which open the circuit for
+            a host, or None to never open it
+        :param reset_timeout: Seconds an open circuit fails requests fast
+            before letting one through to test the host
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def call(self, url, idempotent, func, *args):
+        '''Call func(*args) to make a request to url, subject to the
+        policy for its host.  Only idempotent requests are retried.
+        Raise CircuitOpenError if the host is failing fast.
+        '''
+        host = self._host(urlparse(url).netloc)
+        attempt = 0
+        while True:
+            self._admit(host, url)
+            self._throttle(host)
+            try:
+                result = func(*args)
+            except urllib2.HTTPError, e:
+                if e.code not in self.RETRY_STATUS:
+                    # The host is up; the error is for the caller
+                    self._succeeded(host)
+                    raise
+                if (self._failed(host) or not idempotent
+                    or attempt >= self.retries):
+                    raise
+                delay = self._delay(attempt, e.info().getheader('retry-after'))
+                e.close()
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                if (self._failed(host) or not idempotent
+                    or attempt >= self.retries):
+                    raise
+                delay = self._delay(attempt)
+            else:
+                self._succeeded(host)
+                return result
+            attempt += 1
+            with self._lock:
+                host['retries'] += 1
+            _log.info('retry %d of %s in %.2fs', attempt, url, delay)
+            time.sleep(delay)
+
+    def state(self):
+        '''Map each host seen to its circuit state ('closed', 'open' or
+        'half-open'), consecutive failures, available tokens and totals
+        of requests, retries, failures and fast failures'''
+        now = time.time()
+        with self._lock:
+            result = {}
+            for name, host in self._hosts.items():
+                info = dict((k, host[k]) for k in ('circuit', 'failed',
+                            'requests', 'retries', 'failures', 'rejected'))
+                if self.rate:
+                    info['tokens'] = min(self.burst, host['tokens'] +
+                                         (now - host['stamp']) * self.rate)
+                if host['circuit'] == 'open':
+                    info['retry_in'] = max(0.0, host['opened'] +
+                                           self.reset_timeout - now)
+                result[name] = info
+            return result
+
+    def reset(self, netloc=None):
+        '''Close the circuit for a host, or for all hosts'''
+        with self._lock:
+            for name, host in self._hosts.items():
+                if netloc is None or name == netloc:
+                    host.update(circuit='closed', failed=0, trial=False)
+
+    def _host(self, netloc):
+        with self._lock:
+            host = self._hosts.get(netloc)
+            if host is None:
+                host = self._hosts[netloc] = dict(
+                    name=netloc, circuit='closed', failed=0, opened=0.0, trial=False,
+                    tokens=float(self.burst), stamp=time.time(),
+                    requests=0, retries=0, failures=0, rejected=0)
+            return host
+
+    def _admit(self, host, url):
+        '''Fail fast if the circuit is open.  After reset_timeout, let a
+        single trial request through.'''
+        with self._lock:
+            host['requests'] += 1
+            if host['circuit'] == 'closed':
+                return
+            if (host['circuit'] == 'open'
+                and time.time() - host['opened'] >= self.reset_timeout):
+                host['circuit'] = 'half-open'
+                host['trial'] = False
+            if host['circuit'] == 'half-open' and not host['trial']:
+                host['trial'] = True
+                return
+            host['rejected'] += 1
+        raise CircuitOpenError('host of %s is failing; not trying' % url)
+
+    def _throttle(self, host):
+        '''Wait for a token from the host's bucket'''
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            tokens = min(self.burst,
+                         host['tokens'] + (now - host['stamp']) * self.rate)
+            # Take the token now, going into debt if need be, so that
+            # waiting threads are served in turn
+            host['tokens'] = tokens - 1
+            host['stamp'] = now
+        if tokens < 1:
+            time.sleep((1 - tokens) / self.rate)
+
+    def _succeeded(self, host):
+        with self._lock:
+            host.update(circuit='closed', failed=0, trial=False)
+
+    def _failed(self, host):
+        '''Count a failure.  Return True if the circuit is now open.'''
+        with self._lock:
+            host['failed'] += 1
+            host['failures'] += 1
+            if host['circuit'] == 'half-open' or (
+                    self.failures and host['failed'] >= self.failures):
+                if host['circuit'] != 'open':
+                    _log.warning('circuit for %s open after %d failures',
+                                 host['name'], host['failed'])
+                host.update(circuit='open', opened=time.time(), trial=False)
+                return True
+        return False
+
+    def _delay(self, attempt, retry_after=None):
+        '''Seconds to wait before retrying: full jitter over an
+        exponentially growing window, but at least any Retry-After'''
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if retry_after and retry_after.strip().isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        return delay
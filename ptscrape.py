@@ -1,77 +1,1567 @@
 #=======================================================================
 #       Screen-scraping framework
+#
+# Heavier modules (BeautifulSoup, urllib2, sqlite3 and so on) are imported
+# where first needed, so that command-line tools start quickly and
+# replaying pages never loads the HTTP stack.
 #=======================================================================
 import logging
-try:
-    import bs4 as soup
-except ImportError:
-    import BeautifulSoup as soup
-import urllib2
-from urllib import urlencode
-from urlparse import urljoin
-import cookielib
+from urlparse import urlparse
+import functools
+import time
 import os
 import re
+import sys
+import threading
+import zlib
+from bisect import bisect_left
 
 _log = logging.getLogger(__name__)
 
+class _LazyModule(object):
+    '''Stand-in for a module which is imported on first attribute access.
+    The first of names which can be imported is used.'''
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = __import__(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+# BeautifulSoup 4, else 3
+soup = _LazyModule('bs4', 'BeautifulSoup')
+
+class CacheEntry(object):
+    '''A page held in a PageCache'''
+    __slots__ = ('key', 'content', 'method', 'url', 'status', 'headers',
+                 'stored')
+
+    def __init__(self, key, content, method, url, status, headers, stored):
+        self.key = key
+        self.content = content
+        self.method = method
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.stored = stored
+
+    def message(self):
+        '''Stored response headers as a mimetools.Message'''
+        import mimetools
+        from cStringIO import StringIO
+        return mimetools.Message(StringIO(self.headers or ''))
+
+    def age(self):
+        return time.time() - self.stored
+
+    def freshness(self, default_ttl):
+        '''Seconds after storing for which the page needs no revalidation,
+        from Cache-Control or Expires, else default_ttl'''
+        msg = self.message()
+        directives = [d.strip().lower()
+                      for d in msg.getheader('cache-control', '').split(',')]
+        if 'no-cache' in directives or 'no-store' in directives:
+            return 0
+        for d in directives:
+            if d.startswith('max-age='):
+                try:
+                    return int(d[8:])
+                except ValueError:
+                    pass
+        expires = http_date(msg.getheader('expires'))
+        if expires is not None:
+            date = http_date(msg.getheader('date'))
+            return max(0, expires - (date or self.stored))
+        return default_ttl
+
+    def validators(self):
+        '''Conditional request headers to revalidate this page'''
+        msg = self.message()
+        headers = {}
+        if msg.getheader('etag'):
+            headers['If-None-Match'] = msg.getheader('etag')
+        if msg.getheader('last-modified'):
+            headers['If-Modified-Since'] = msg.getheader('last-modified')
+        return headers
+
+class PageCache(object):
+    '''Compressed page store, evicting least recently used pages once the
+    total size exceeds a byte budget.
+    Bodies are kept in objects/<k[:2]>/<key>, either zlib-compressed by
+    the cache or as received with a gzip or deflate Content-Encoding,
+    and index.sqlite records method, URL, status, headers, size, times
+    and that encoding.
+    '''
+    DEFAULT_MAX_BYTES = 100 * 2**20
+
+    def __init__(self, cachedir, max_bytes=DEFAULT_MAX_BYTES,
+                 readonly=False):
+        '''
+        :param cachedir: Folder to hold the cache
+        :param max_bytes: Budget for compressed bodies, or None for no limit
+        :param readonly: If True, only read an existing cache: get() does
+            not record access times or drop pages with missing bodies,
+            and storing pages is an error
+        '''
+        self.cachedir = os.path.expanduser(cachedir)
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.objdir = os.path.join(self.cachedir, 'objects')
+        dbpath = os.path.join(self.cachedir, 'index.sqlite')
+        import sqlite3
+        self._lock = threading.Lock()
+        if readonly:
+            if not os.path.exists(dbpath):
+                raise IOError('No page cache in %s' % self.cachedir)
+            self._db = sqlite3.connect(dbpath, check_same_thread=False)
+            columns = [row[1] for row in
+                       self._db.execute('PRAGMA table_info(pages)')]
+            # Caches from before the encoding column hold only deflate
+            self._encoding = 'encoding' if 'encoding' in columns else 'NULL'
+            self._total = self._sum_sizes()
+            return
+        self._encoding = 'encoding'
+        if not os.path.isdir(self.objdir):
+            os.makedirs(self.objdir)
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         ' key TEXT PRIMARY KEY, method TEXT, url TEXT,'
+                         ' status INTEGER, headers TEXT, size INTEGER,'
+                         ' stored REAL, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_accessed'
+                         ' ON pages (accessed)')
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(pages)')]
+        if 'encoding' not in columns:
+            # NULL for bodies compressed by the cache itself
+            self._db.execute('ALTER TABLE pages ADD COLUMN encoding TEXT')
+        self._db.commit()
+        self._total = self._sum_sizes()
+
+    @staticmethod
+    def key(method, url, data=None, tag=None):
+        '''Cache key for a request'''
+        import hashlib
+        h = hashlib.sha1()
+        for part in (method, url, data or '', tag or ''):
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            h.update(part)
+            h.update('\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.objdir, key[:2], key)
+
+    def _sum_sizes(self):
+        return self._db.execute('SELECT COALESCE(SUM(size), 0)'
+                                ' FROM pages').fetchone()[0]
+
+    def get(self, key):
+        '''Return the CacheEntry for key, or None'''
+        with self._lock:
+            row = self._db.execute('SELECT method, url, status, headers,'
+                                   ' stored, %s FROM pages WHERE key = ?'
+                                   % self._encoding, (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self._path(key), 'rb') as f:
+                    content = decode_body(f.read(), row[-1] or 'deflate')
+            except (IOError, zlib.error):
+                _log.warning('cache body for %s missing or corrupt', key)
+                if self.readonly:
+                    return None
+                self._delete([key])
+                self._total = self._sum_sizes()
+                return None
+            if not self.readonly:
+                self._db.execute('UPDATE pages SET accessed = ?'
+                                 ' WHERE key = ?', (time.time(), key))
+                self._db.commit()
+        return CacheEntry(key, content, *row[:-1])
+
+    def index(self):
+        '''(key, method, url, status, headers, stored) for every page,
+        oldest first'''
+        with self._lock:
+            return self._db.execute('SELECT key, method, url, status,'
+                                    ' headers, stored FROM pages'
+                                    ' ORDER BY stored').fetchall()
+
+    def refresh(self, key, headers):
+        '''Mark a page as just validated, e.g. by a 304 response, taking
+        updated validators and freshness headers from that response'''
+        if self.readonly:
+            raise IOError('Page cache %s is read-only' % self.cachedir)
+        import mimetools
+        from cStringIO import StringIO
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT headers FROM pages WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return
+            msg = mimetools.Message(StringIO(row[0] or ''))
+            for name in ('etag', 'last-modified', 'cache-control',
+                         'expires', 'date'):
+                value = headers.getheader(name)
+                if value is not None:
+                    del msg[name]
+                    msg[name] = value
+            self._db.execute('UPDATE pages SET headers = ?, stored = ?,'
+                             ' accessed = ? WHERE key = ?',
+                             (str(msg), now, now, key))
+            self._db.commit()
+
+    def put(self, key, content, **meta):
+        '''Store content under key, evicting old pages if over budget.
+        Parameters are as for writer().'''
+        writer = self.writer(key, **meta)
+        writer.write(content)
+        writer.commit()
+
+    def writer(self, key, method=None, url=None, status=None, headers=None,
+               encoding=None):
+        '''Return a CacheWriter to store content under key chunk by chunk
+        :param encoding: 'gzip' or 'deflate' if the content is already
+            compressed that way, to be stored as is; see decode_body()
+        '''
+        if self.readonly:
+            raise IOError('Page cache %s is read-only' % self.cachedir)
+        return CacheWriter(self, key, (method, url, status, headers, encoding))
+
+    def _add(self, key, size, meta):
+        '''Index a body just written by a CacheWriter'''
+        method, url, status, headers, encoding = meta
+        now = time.time()
+        with self._lock:
+            old = self._db.execute('SELECT size FROM pages WHERE key = ?',
+                                   (key,)).fetchone()
+            if old:
+                self._total -= old[0]
+            self._db.execute('INSERT OR REPLACE INTO pages (key, method,'
+                             ' url, status, headers, size, stored, accessed,'
+                             ' encoding) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, method, url, status, headers,
+                              size, now, now, encoding))
+            self._total += size
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        '''Drop least recently used pages down to 90% of the budget'''
+        if self.max_bytes is None or self._total <= self.max_bytes:
+            return
+        # Other processes may share the cache, so recount before evicting
+        self._total = self._sum_sizes()
+        target = self.max_bytes * 0.9
+        victims = []
+        for key, size in self._db.execute('SELECT key, size FROM pages'
+                                          ' ORDER BY accessed'):
+            if self._total <= target:
+                break
+            victims.append(key)
+            self._total -= size
+        if victims:
+            _log.info('cache evicting %d pages', len(victims))
+            self._delete(victims)
+
+    def _delete(self, keys):
+        self._db.executemany('DELETE FROM pages WHERE key = ?',
+                             [(k,) for k in keys])
+        self._db.commit()
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+    def close(self):
+        self._db.close()
+
+class SessionStore(object):
+    '''Cookies and the time a session was last validated, kept in a JSON
+    file shared between processes under a lock file'''
+
+    def __init__(self, path, max_age=900):
+        '''
+        :param path: Session file
+        :param max_age: Seconds a session stays valid after validation
+        '''
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        self.validated = None
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def _lock(self, exclusive):
+        import fcntl
+        f = open(self.path + '.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return f
+
+    def valid(self):
+        return (self.validated is not None
+                and time.time() - self.validated < self.max_age)
+
+    def load(self, jar):
+        '''Add stored cookies which have not expired to jar'''
+        import cookielib
+        import json
+        lock = self._lock(exclusive=False)
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+        finally:
+            lock.close()
+        self.validated = state.get('validated')
+        now = time.time()
+        for c in state.get('cookies', []):
+            # Keep cookies as byte strings, as cookielib makes them
+            c = dict((str(k), _utf8(v)) for k, v in c.items())
+            c['rest'] = dict((_utf8(k), _utf8(v))
+                             for k, v in (c['rest'] or {}).items())
+            cookie = cookielib.Cookie(**c)
+            if not cookie.is_expired(now):
+                jar.set_cookie(cookie)
+
+    def save(self, jar, validated=False):
+        '''Store the cookies in jar.
+        :param validated: Time the session was validated, None if it is no
+            longer valid, or False to keep the previous time
+        '''
+        import json
+        if validated is not False:
+            self.validated = validated
+        cookies = []
+        for c in jar:
+            cookies.append(dict(
+                version=c.version, name=c.name, value=c.value,
+                port=c.port, port_specified=c.port_specified,
+                domain=c.domain, domain_specified=c.domain_specified,
+                domain_initial_dot=c.domain_initial_dot,
+                path=c.path, path_specified=c.path_specified,
+                secure=c.secure, expires=c.expires, discard=c.discard,
+                comment=c.comment, comment_url=c.comment_url,
+                rest=c._rest, rfc2109=c.rfc2109))
+        state = dict(validated=self.validated, cookies=cookies)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        lock = self._lock(exclusive=True)
+        try:
+            with open(tmp, 'w') as f:
+                os.chmod(tmp, 0600)
+                json.dump(state, f)
+            os.rename(tmp, self.path)
+        finally:
+            lock.close()
+
+class CacheWriter(object):
+    '''Compresses a page into a PageCache as its chunks arrive, or stores
+    chunks already compressed in transfer as they are.
+    Nothing is visible in the cache until commit().
+    '''
+
+    def __init__(self, cache, key, meta):
+        self._cache = cache
+        self._key = key
+        self._meta = meta
+        self._path = cache._path(key)
+        dirname = os.path.dirname(self._path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._tmp = '%s.%d.%d' % (self._path, os.getpid(),
+                                  threading.current_thread().ident)
+        self._file = open(self._tmp, 'wb')
+        self._zip = None
+        if meta[-1] is None:
+            self._zip = zlib.compressobj()
+        self.size = 0
+
+    def write(self, chunk):
+        packed = self._zip.compress(chunk) if self._zip else chunk
+        self._file.write(packed)
+        self.size += len(packed)
+
+    def commit(self):
+        if self._zip:
+            packed = self._zip.flush()
+            self._file.write(packed)
+            self.size += len(packed)
+        self._file.close()
+        os.rename(self._tmp, self._path)
+        self._cache._add(self._key, self.size, self._meta)
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self._tmp)
+
+class ExtractCache(object):
+    '''Results of extracting data from pages, keyed by a hash of the page
+    content with the extractor's name and version, so that an unchanged
+    page need not be parsed again.  Kept in an sqlite file; least
+    recently used results are evicted beyond max_entries.
+    See extractor().
+    '''
+    DEFAULT_MAX_ENTRIES = 10000
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        '''
+        :param path: sqlite file to hold the results
+        :param max_entries: Most results to keep, or None for no limit
+        '''
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+                         ' digest TEXT, name TEXT, version TEXT,'
+                         ' result BLOB, accessed REAL,'
+                         ' PRIMARY KEY (digest, name, version))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed'
+                         ' ON results (accessed)')
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*)'
+                                       ' FROM results').fetchone()[0]
+        self._current = set()   # (name, version) checked this run
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, name, version, content, func, args):
+        '''Return the stored result of func(*args) for this content, or
+        call it and store the result'''
+        import cPickle
+        import hashlib
+        import sqlite3
+        version = str(version)
+        if (name, version) not in self._current:
+            self.invalidate(name, version)
+            self._current.add((name, version))
+        digest = hashlib.sha1(content).hexdigest()
+        with self._lock:
+            row = self._db.execute('SELECT result FROM results WHERE'
+                                   ' digest = ? AND name = ? AND version = ?',
+                                   (digest, name, version)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE results SET accessed = ? WHERE'
+                                 ' digest = ? AND name = ? AND version = ?',
+                                 (time.time(), digest, name, version))
+                self._db.commit()
+                self.hits += 1
+                return cPickle.loads(str(row[0]))
+            self.misses += 1
+        result = func(*args)
+        blob = sqlite3.Binary(cPickle.dumps(result, 2))
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO results'
+                             ' VALUES (?, ?, ?, ?, ?)',
+                             (digest, name, version, blob, time.time()))
+            self._count += 1
+            self._evict()
+            self._db.commit()
+        return result
+
+    def invalidate(self, name, version=None):
+        '''Drop results of an extractor, except those of version'''
+        with self._lock:
+            if version is None:
+                cur = self._db.execute('DELETE FROM results WHERE name = ?',
+                                       (name,))
+            else:
+                cur = self._db.execute('DELETE FROM results WHERE name = ?'
+                                       ' AND version != ?',
+                                       (name, str(version)))
+            if cur.rowcount:
+                _log.info('dropped %d results of %s', cur.rowcount, name)
+                self._count -= cur.rowcount
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM results')
+            self._db.commit()
+            self._count = 0
+
+    def _evict(self):
+        '''Drop least recently used results down to 90% of max_entries'''
+        if self.max_entries is None or self._count <= self.max_entries:
+            return
+        excess = self._count - int(self.max_entries * 0.9)
+        self._db.execute('DELETE FROM results WHERE rowid IN'
+                         ' (SELECT rowid FROM results ORDER BY accessed'
+                         ' LIMIT ?)', (excess,))
+        self._count = self._db.execute('SELECT COUNT(*)'
+                                       ' FROM results').fetchone()[0]
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=self._count)
+
+    def close(self):
+        self._db.close()
+
+def extractor(name, version=1):
+    '''Decorator memoising a function which extracts data from a Page,
+    given as its last argument, in the ExtractCache of the page, if any;
+    see PageSource.  On a hit the page is not parsed at all.
+    The result must depend only on the page content and be picklable.
+    :param name: Unique name for the extractor
+    :param version: Change this whenever the extraction changes, to
+        discard results stored by older versions
+    '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            page = args[-1]
+            if page.memo is None or page.content is None:
+                return func(*args)
+            return page.memo.call(name, version, page.content, func, args)
+        return wrapper
+    return decorate
+
 class PageSource(object):
-    def __init__(self, cachedir=None, replay=False):
+    def __init__(self, cachedir=None, replay=False, per_host=2,
+                 keepalive=True, pool_size=4, idle_timeout=60.0,
+                 cache_bytes=PageCache.DEFAULT_MAX_BYTES,
+                 revalidate=False, ttl=60, parser=None, session=None,
+                 session_age=900, metrics=None, scheduler=None,
+                 compress=True, memo=None, timeout=None):
+        '''
+        :param cachedir: Folder to hold saved web pages
+        :param session: File to keep cookies in between runs; not used
+            with replay
+        :param session_age: Seconds a session stays valid after login, or
+            after a page showing it still works; see mark_session_valid()
+        :param parser: Default parser backend for pages; see parse()
+        :param cache_bytes: Budget for the page cache, or None for no limit
+        :param replay: If True, read from cachedir instead of web site
+        :param revalidate: If True, serve fresh cached GETs without a
+            request, and revalidate stale ones with If-None-Match or
+            If-Modified-Since
+        :param ttl: Freshness in seconds for pages without Cache-Control
+            or Expires headers
+        :param per_host: Maximum concurrent requests to one host in get_many
+        :param keepalive: If True, reuse HTTP/1.1 connections between requests
+        :param pool_size: Maximum idle connections kept per host
+        :param idle_timeout: Seconds before an idle connection is discarded
+        :param metrics: Collector told about each phase of each request,
+            as metrics.event(phase, url, seconds, nbytes=None, hit=None);
+            see Metrics
+        :param scheduler: pthttp.Scheduler applying rate limits, retries
+            and circuit breakers to requests; may be shared between sources
+        :param compress: If True, accept gzip or deflate compressed
+            responses.  They are cached as received and decompressed
+            when read.
+        :param memo: ExtractCache for the results of extractor()
+            functions applied to pages from this source
+        :param timeout: Seconds to wait to connect or for response data,
+            or None for the socket default
+        '''
         self.cachedir = cachedir
+        self.compress = compress
+        self.memo = memo
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.timeout = timeout
         self.replay = replay
-        self.jar = cookielib.CookieJar()
-        self.agent = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.jar))
+        self.parser = parser
+        self.revalidate = revalidate
+        self.ttl = ttl
+        self.cache = None
+        if cachedir:
+            self.cache = PageCache(cachedir, cache_bytes)
+        self.per_host = per_host
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self.keepalive = keepalive
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.pool = None
+        self._jar = None
+        self._agent = None
+        self._agent_lock = threading.Lock()
+        self.session = None
+        if session and not replay:
+            self.session = SessionStore(session, session_age)
+            self.session.load(self.jar)
+
+    @property
+    def jar(self):
+        '''Cookie jar, created when first needed'''
+        if self._jar is None:
+            import cookielib
+            self._jar = cookielib.CookieJar()
+        return self._jar
+
+    @property
+    def agent(self):
+        '''urllib2 opener, built on the first request so that replaying
+        never loads the HTTP modules'''
+        with self._agent_lock:
+            if self._agent is None:
+                import urllib2
+                handlers = [urllib2.HTTPCookieProcessor(self.jar)]
+                if self.keepalive:
+                    from pthttp import ConnectionPool, KeepAliveHandler
+                    self.pool = ConnectionPool(self.pool_size,
+                                               self.idle_timeout)
+                    handlers.append(KeepAliveHandler(self.pool))
+                self._agent = urllib2.build_opener(*handlers)
 #                                          urllib2.HTTPRedirectHandler())
+            return self._agent
+
+    def close(self):
+        '''Save the session, and close any pooled connections and the
+        cache index'''
+        if self.session:
+            self.session.save(self.jar)
+        if self.pool:
+            self.pool.close()
+        if self.cache:
+            self.cache.close()
+        if self.memo:
+            self.memo.close()
+
+    def session_valid(self):
+        '''True if a stored session was validated recently enough to be
+        used without logging in again'''
+        return self.session is not None and self.session.valid()
 
-    def get(self, url, query=None, tag=None):
-        '''HTTP GET request on a URL with optional query'''
+    def mark_session_valid(self):
+        '''Record that the current cookies make a logged-in session.
+        Call after logging in, and whenever a page shows the session
+        still works, so that it only expires when the site drops it.'''
+        if self.session:
+            self.session.save(self.jar, validated=time.time())
+
+    def invalidate_session(self):
+        '''Forget the session, e.g. when the site shows a login page'''
+        if self._jar is not None:
+            self._jar.clear()
+        if self.session:
+            self.session.save(self.jar, validated=None)
+
+    def get(self, url, query=None, tag=None, parser=None, only=None,
+            stream=False, until=None):
+        '''HTTP GET request on a URL with optional query.
+        :param only: Regions of the page to parse; see region_strainer()
+        :param stream: If True, parse the body while it downloads; see
+            _stream()
+        :param until: With stream, stop downloading once this is satisfied
+        '''
         if query:
+            from urllib import urlencode
             url += '?' + urlencode(query)
         _log.info('GET %s', url)
-        return self._transact(url, tag=tag)
+        return self._transact(url, tag=tag, parser=parser, only=only,
+                              stream=stream, until=until)
+
+    def get_many(self, urls, tags=None, workers=4, parser=None, only=None):
+        '''HTTP GET several URLs concurrently, yielding Pages as they complete.
+        Requests share the cookie jar and cache of this source; at most
+        per_host requests are in flight to any one host.
+        :param urls: Sequence of URLs
+        :param tags: Optional sequence of cache tags, parallel to urls
+        :param workers: Maximum number of requests in flight overall
+        :param parser: Parser backend for the pages; see parse()
+        :param only: Regions of the pages to parse; see region_strainer()
+        '''
+        import Queue
+        urls = list(urls)
+        if tags is None:
+            tags = [None] * len(urls)
+        elif len(tags) != len(urls):
+            raise ValueError('Got %d tags for %d urls' % (len(tags), len(urls)))
+        if workers < 1:
+            raise ValueError('Need at least one worker, got %r' % workers)
+        jobs = Queue.Queue()
+        for job in zip(urls, tags):
+            jobs.put(job)
+        done = Queue.Queue()
+        def worker():
+            while True:
+                try:
+                    url, tag = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    with self._host_slot(url):
+                        result = (self.get(url, tag=tag, parser=parser,
+                                           only=only), None)
+                except Exception:
+                    result = (None, sys.exc_info())
+                done.put(result)
+        threads = []
+        for i in range(min(workers, len(urls))):
+            t = threading.Thread(target=worker, name='get_many-%d' % i)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for i in range(len(urls)):
+            page, exc = done.get()
+            if exc:
+                raise exc[0], exc[1], exc[2]
+            yield page
+        for t in threads:
+            t.join()
 
-    def post(self, url, query=None, tag=None):
-        '''HTTP POST request on a URL with optional query'''
+    def _host_slot(self, url):
+        '''Semaphore limiting concurrent requests to the host of a URL'''
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def post(self, url, query=None, tag=None, parser=None, only=None,
+             stream=False, until=None):
+        '''HTTP POST request on a URL with optional query.
+        Parameters are as for get().
+        '''
         _log.info('POST %s', url)
         data = ''
         if query:
+            from urllib import urlencode
             data = urlencode(query)
-        return self._transact(url, data, tag=tag)
+        return self._transact(url, data, tag=tag, parser=parser, only=only,
+                              stream=stream, until=until)
 
-    def _transact(self, url, data=None, tag=None):
-        '''Perform an HTTP request, or fetch page from cache'''
-        if tag is None:
-            tag = os.path.basename(url)
+    def _transact(self, url, data=None, tag=None, parser=None, only=None,
+                  stream=False, until=None):
+        '''Perform an HTTP request, or fetch page from cache.
+        The cache key is derived from the method, URL and POST data, plus
+        the tag if given, which tells apart pages fetched from the same
+        URL at different stages (e.g. before and after login).
+        '''
+        method = 'GET' if data is None else 'POST'
+        key = PageCache.key(method, url, data, tag)
+        if stream and not self.replay and not (
+                self.revalidate and self.cache and method == 'GET'):
+            content, doc = self._stream(url, data, method, key, until)
+            return Page(url, content, 'etree', doc=doc, memo=self.memo)
+        if stream:
+            parser = 'etree'
         if self.replay:
-            content = self.read_cache(tag)
+            start = time.time()
+            content = self.read_cache(key, tag or os.path.basename(url))
+            self._event('cache_read', url, start, len(content), hit=True)
+        elif self.revalidate and self.cache and method == 'GET':
+            content = self._revalidate(url, key)
         else:
-            doc = self.agent.open(url, data)
-            _log.info('info %r', doc.info())
-            content = doc.read()
-            if self.cachedir:
-                self.write_cache(tag, content)
-        doc = soup.BeautifulSoup(content)
-        return Page(url, doc)
-
-    def read_cache(self, tag):
-        cachefile = os.path.join(os.path.expanduser(self.cachedir), tag)
-        with open(cachefile, 'rb') as f:
-            content = f.read()
+            content = self._fetch(url, data, method, key)
+        return Page(url, content, parser or self.parser, only,
+                    hook=self._event if self.metrics else None,
+                    memo=self.memo)
+
+    def _event(self, phase, url, start, nbytes=None, hit=None):
+        '''Report a phase of a request, begun at time start, to metrics'''
+        if self.metrics:
+            self.metrics.event(phase, url, time.time() - start,
+                               nbytes=nbytes, hit=hit)
+
+    def _open(self, url, data, headers={}):
+        '''Send a request through the scheduler, if any'''
+        if self.scheduler is None:
+            return self._send(url, data, headers)
+        return self.scheduler.call(url, data is None, self._send,
+                                   url, data, headers)
+
+    def _send(self, url, data, headers={}):
+        '''Send a request, reporting connect and time to first byte'''
+        import urllib2
+        if self.compress:
+            headers = dict(headers)
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        # urllib2 treats timeout=None as no timeout, not the default
+        kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+        start = time.time()
+        try:
+            doc = self.agent.open(urllib2.Request(url, data, headers),
+                                  **kwargs)
+        except urllib2.HTTPError:
+            # Includes 304 Not Modified when revalidating
+            self._event('ttfb', url, start)
+            raise
+        if self.metrics:
+            timings = getattr(doc, 'timings', None)
+            if timings is None:
+                # Without the pool, connecting is not timed separately
+                self._event('ttfb', url, start)
+            else:
+                connect, ttfb = timings
+                if connect is not None:
+                    self.metrics.event('connect', url, connect)
+                self.metrics.event('ttfb', url, ttfb)
+        _log.debug('headers for %s:\n%s', url, doc.info())
+        return doc
+
+    def _fetch(self, url, data, method, key, headers={}):
+        '''Fetch a page from the web site, saving it in the cache'''
+        if self.scheduler is None:
+            doc, body = self._download(url, data, headers)
+        else:
+            # Retry covers the body too, unlike _stream
+            doc, body = self.scheduler.call(url, data is None,
+                                            self._download,
+                                            url, data, headers)
+        encoding = content_encoding(doc.info())
+        content = body
+        if encoding:
+            start = time.time()
+            content = decode_body(body, encoding)
+            self._event('decode', url, start, len(content))
+        if self.cache:
+            start = time.time()
+            self.write_cache(key, body, method=method, url=url,
+                             status=doc.code, headers=str(doc.info()),
+                             encoding=encoding)
+            self._event('cache_write', url, start, len(body))
         return content
 
-    def write_cache(self, tag, content):
-        cachefile = os.path.join(os.path.expanduser(self.cachedir), tag)
-        with open(cachefile, 'wb') as f:
-            f.write(content)
+    def _download(self, url, data, headers={}):
+        '''Send a request and read the whole response.
+        Return (response, content)'''
+        doc = self._send(url, data, headers)
+        start = time.time()
+        content = doc.read()
+        self._event('download', url, start, len(content))
+        return doc, content
+
+    def _stream(self, url, data, method, key, until=None, chunk_size=16384):
+        '''Fetch a page, feeding chunks to an incremental lxml parser and
+        to the cache as they arrive.
+        :param until: Callable taking each completed element and returning
+            True to stop, or a list of region selectors (see
+            region_strainer()) to stop once all of them have been seen.
+            A page cut short this way is not cached.
+        Return (content, root element).
+        '''
+        import lxml.etree
+        if until is None:
+            parser = lxml.etree.HTMLParser()
+        else:
+            parser = lxml.etree.HTMLPullParser(events=('end',))
+            if not callable(until):
+                until = _RegionsSeen(until)
+        doc = self._open(url, data)
+        start = time.time()
+        encoding = content_encoding(doc.info())
+        writer = None
+        if self.cache:
+            writer = self.cache.writer(key, method=method, url=url,
+                                       status=doc.code,
+                                       headers=str(doc.info()),
+                                       encoding=encoding)
+        decoder = _Decoder(encoding) if encoding else None
+        chunks = []
+        stopped = False
+        try:
+            while not stopped:
+                chunk = doc.read(chunk_size)
+                if not chunk:
+                    if decoder:
+                        chunk = decoder.flush()
+                        chunks.append(chunk)
+                        parser.feed(chunk)
+                    break
+                if writer:
+                    writer.write(chunk)
+                if decoder:
+                    chunk = decoder.decompress(chunk)
+                chunks.append(chunk)
+                parser.feed(chunk)
+                if until is not None:
+                    for event, element in parser.read_events():
+                        if until(element):
+                            stopped = True
+                            break
+        except:
+            # Leave no partial body behind in the cache
+            doc.close()
+            if writer:
+                writer.abort()
+            raise
+        content = ''.join(chunks)
+        # Includes incremental parsing, which overlaps the download
+        self._event('download', url, start, len(content))
+        if stopped:
+            _log.info('stopped reading %s after %d bytes', url, len(content))
+            doc.close()
+            if writer:
+                writer.abort()
+        elif writer:
+            start = time.time()
+            writer.commit()
+            self._event('cache_write', url, start, writer.size)
+        return content, parser.close()
+
+    def _revalidate(self, url, key):
+        '''Get a page from the cache if fresh, else with a conditional GET'''
+        import urllib2
+        start = time.time()
+        entry = self.cache.get(key)
+        if entry is None:
+            self._event('cache_read', url, start, hit=False)
+            return self._fetch(url, None, 'GET', key)
+        if entry.age() < entry.freshness(self.ttl):
+            _log.info('fresh %s', url)
+            self._event('cache_read', url, start, len(entry.content), hit=True)
+            return entry.content
+        self._event('cache_read', url, start, len(entry.content), hit=False)
+        try:
+            return self._fetch(url, None, 'GET', key, entry.validators())
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                raise
+            e.read()
+            _log.info('not modified %s', url)
+            self.cache.refresh(key, e.info())
+            return entry.content
+
+    def read_cache(self, key, tag=None):
+        '''Get cached content by key.  Fall back to a page saved under its
+        tag by older versions, which kept one flat file per tag.'''
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry.content
+        if tag:
+            cachefile = os.path.join(self.cache.cachedir, tag)
+            if os.path.isfile(cachefile):
+                with open(cachefile, 'rb') as f:
+                    return f.read()
+        raise IOError('No cached page for key %s (tag %s)' % (key, tag))
+
+    def write_cache(self, key, content, **meta):
+        self.cache.put(key, content, **meta)
+
+class Metrics(object):
+    '''Counters and histograms fed by PageSource request phases:
+    connect, ttfb (time to first byte), download, cache_read,
+    cache_write and parse.  Any object with an event() method taking
+    the same arguments can be used instead.
+    '''
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS, prefix='ptscrape'):
+        '''
+        :param buckets: Upper bounds in seconds of the histogram buckets
+        :param prefix: Prepended to the metric names in dump()
+        '''
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [count per bucket..., sum]
+        self._lock = threading.Lock()
+
+    def event(self, phase, url, seconds, nbytes=None, hit=None):
+        '''Record a phase of a request to url which took seconds'''
+        host = urlparse(url).netloc
+        labels = (('phase', phase), ('host', host))
+        with self._lock:
+            self._observe('phase_seconds', labels, seconds)
+            if nbytes is not None:
+                self._inc('bytes_total', labels, nbytes)
+            if hit is not None:
+                result = 'hit' if hit else 'miss'
+                self._inc('cache_total', (('host', host), ('result', result)),
+                          1)
+
+    def inc(self, name, labels=(), value=1):
+        '''Add value to a counter'''
+        with self._lock:
+            self._inc(name, tuple(labels), value)
+
+    def observe(self, name, labels, value):
+        '''Add a value to a histogram'''
+        with self._lock:
+            self._observe(name, tuple(labels), value)
+
+    def _inc(self, name, labels, value):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(self.buckets) + 2)
+        hist[bisect_left(self.buckets, value)] += 1
+        hist[-1] += value
+
+    def totals(self, name='phase_seconds', label='phase'):
+        '''Map each value of a label to (count, total) for a histogram'''
+        result = {}
+        with self._lock:
+            for (hname, labels), hist in self.histograms.items():
+                if hname != name:
+                    continue
+                value = dict(labels).get(label)
+                count, total = result.get(value, (0, 0.0))
+                result[value] = (count + sum(hist[:-1]), total + hist[-1])
+        return result
+
+    def dump(self):
+        '''Text exposition of all counters and histograms, in the
+        Prometheus format'''
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v))
+                                for k, v in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        for (name, labels), hist in histograms:
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), hist[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels + (('le', str(bound)),)),
+                    cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), hist[-1]))
+            lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                           .replace('"', '\\"'))
+                             for k, v in labels)
 
 class Page(object):
-    def __init__(self, url, doc):
+    '''A fetched page.  The raw content is parsed on first access to doc.'''
+    __slots__ = ('url', 'content', 'parser', 'only', 'hook', 'memo', '_doc')
+
+    def __init__(self, url, content, parser=None, only=None, doc=None,
+                 hook=None, memo=None):
+        '''
+        :param parser: Parser backend; see parse()
+        :param only: Regions to parse; see region_strainer()
+        :param doc: Parse tree, if already built
+        :param hook: Called as hook('parse', url, start, nbytes) after
+            parsing; see PageSource._event()
+        :param memo: ExtractCache for extractor() functions
+        '''
         self.url = url
-        self.doc = doc
+        self.content = content
+        self.parser = parser
+        self.only = only
+        self.hook = hook
+        self.memo = memo
+        self._doc = doc
+
+    @property
+    def doc(self):
+        '''Parse tree of the page, built when first needed'''
+        if self._doc is None:
+            if self.content is None:
+                raise ValueError('Page %s has been released' % self.url)
+            start = time.time()
+            self._doc = parse(self.content, self.parser, self.only)
+            if self.hook:
+                self.hook('parse', self.url, start, len(self.content))
+        return self._doc
+
+    def release(self, content=False):
+        '''Drop the parse tree once extraction is done, so its memory can
+        be reclaimed.  Elements taken from the tree must not be used after
+        this.  If content is True, also drop the raw content.
+        '''
+        if self._doc is not None and hasattr(self._doc, 'decompose'):
+            self._doc.decompose()
+        self._doc = None
+        if content:
+            self.content = None
+
+def content_encoding(headers):
+    '''Compression of a response body from its Content-Encoding header:
+    'gzip', 'deflate' or None'''
+    encoding = (headers.getheader('content-encoding') or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return 'gzip'
+    if encoding == 'deflate':
+        return 'deflate'
+    if encoding not in ('', 'identity'):
+        _log.warning('unexpected Content-Encoding %r', encoding)
+    return None
+
+def decode_body(body, encoding):
+    '''Decompress a gzip or deflate encoded body.  Some servers send
+    deflate without the zlib header, so try that too.'''
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    try:
+        return zlib.decompress(body)
+    except zlib.error:
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+class _Decoder(object):
+    '''Incremental form of decode_body()'''
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._raw = encoding == 'gzip'
+        self._zip = zlib.decompressobj(16 + zlib.MAX_WBITS if self._raw
+                                       else zlib.MAX_WBITS)
+        self._first = True
+
+    def decompress(self, chunk):
+        if self._first:
+            self._first = False
+            if not self._raw:
+                try:
+                    return self._zip.decompress(chunk)
+                except zlib.error:
+                    # deflate without the zlib header
+                    self._zip = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._zip.decompress(chunk)
+
+    def flush(self):
+        return self._zip.flush()
+
+@extractor('ptscrape.page_title')
+def page_title(page):
+    '''Text of the <title> of a page, or None'''
+    doc = page.doc
+    title = doc.find('title')
+    if title is None and hasattr(doc, 'iter'):
+        # lxml tree from the etree backend
+        title = doc.find('.//title')
+    return None if title is None else bs_cdata(title)
+
+def http_date(value):
+    '''Seconds since the epoch for an HTTP date header, or None'''
+    if not value:
+        return None
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+_default_parser = None
+
+def parse(content, parser=None, only=None):
+    '''Parse content with the named backend.
+    'etree' and 'etree-xml' build an lxml tree directly, skipping
+    BeautifulSoup.  Other names are bs4 tree builders, such as
+    'html.parser', 'lxml' or 'xml'.  None uses lxml if it is installed,
+    else html.parser.
+    :param only: With a bs4 backend, build only these regions of the
+        page; see region_strainer().  The etree backends parse it all.
+    '''
+    global _default_parser
+    if parser is None:
+        if _default_parser is None:
+            try:
+                import lxml
+                _default_parser = 'lxml'
+            except ImportError:
+                _default_parser = 'html.parser'
+        parser = _default_parser
+    if parser == 'etree':
+        import lxml.html
+        return lxml.html.document_fromstring(content)
+    if parser == 'etree-xml':
+        import lxml.etree
+        return lxml.etree.fromstring(content)
+    if not hasattr(soup, 'FeatureNotFound'):
+        # BeautifulSoup 3 has a single built-in parser
+        if only is not None:
+            return soup.BeautifulSoup(content,
+                                      parseOnlyThese=region_strainer(only))
+        return soup.BeautifulSoup(content)
+    if only is not None:
+        return soup.BeautifulSoup(content, parser,
+                                  parse_only=region_strainer(only))
+    return soup.BeautifulSoup(content, parser)
+
+_region_re = re.compile(r'^(\w*)(?:#([\w-]+))?(?:\.([\w-]+))?$')
+
+def region_strainer(regions):
+    '''SoupStrainer which keeps only some regions of a page, plus its <title>.
+    :param regions: A SoupStrainer, used as is, or a list of simple
+        selectors: 'tag', '#id', '.class', 'tag#id' or 'tag.class'
+    '''
+    if isinstance(regions, soup.SoupStrainer):
+        return regions
+    return soup.SoupStrainer(region_matcher(['title'] + list(regions)))
+
+def region_matcher(regions):
+    '''Function of (name, attrs) which is True for an element matching
+    any of the selectors in regions; see region_strainer()'''
+    specs = []
+    for region in regions:
+        m = _region_re.match(region)
+        if not m or not any(m.groups()):
+            raise ValueError('Bad region selector %r' % region)
+        specs.append(m.groups())
+    def match(name, attrs):
+        if attrs is None:
+            attrs = {}
+        elif not isinstance(attrs, dict):
+            attrs = dict(attrs)
+        for tag, id, cls in specs:
+            if tag and name != tag:
+                continue
+            if id and attrs.get('id') != id:
+                continue
+            if cls:
+                classes = attrs.get('class') or ''
+                if isinstance(classes, basestring):
+                    classes = classes.split()
+                if cls not in classes:
+                    continue
+            return True
+        return False
+    return match
+
+class _RegionsSeen(object):
+    '''Stop condition for PageSource._stream: true once an element
+    matching each of the region selectors has been completed'''
+
+    def __init__(self, regions):
+        self.pending = [region_matcher([r]) for r in regions]
+
+    def __call__(self, element):
+        self.pending = [m for m in self.pending
+                        if not m(element.tag, element.attrib)]
+        return not self.pending
 
 def bs_cdata(tag):
-    '''Get the character data inside a BeautifulSoup element, ignoring all markup'''
-    return ''.join(tag.findAll(text=True))
+    '''Get the character data inside an element, ignoring all markup.
+    Accepts BeautifulSoup elements and lxml elements from the etree backends.
+    '''
+    if hasattr(tag, 'findAll'):
+        return ''.join(tag.findAll(text=True))
+    return u''.join(tag.itertext())
+
+def walk(node):
+    '''Generate parse events for a subtree in document order:
+    ('start', name, attrs, element), ('text', string) and ('end', name).
+    Works on BeautifulSoup and lxml trees without recursion.
+    '''
+    if hasattr(node, 'findAll'):
+        return _walk_soup(node)
+    return _walk_etree(node)
+
+def _walk_soup(node):
+    Tag = soup.Tag
+    NavigableString = soup.NavigableString
+    yield ('start', node.name, node.attrs, node)
+    stack = [(node, iter(node.contents))]
+    while stack:
+        parent, children = stack[-1]
+        for child in children:
+            if isinstance(child, Tag):
+                yield ('start', child.name, child.attrs, child)
+                stack.append((child, iter(child.contents)))
+                break
+            if child.__class__ is NavigableString:
+                yield ('text', child)
+        else:
+            stack.pop()
+            yield ('end', parent.name)
+
+def _walk_etree(node):
+    stack = [(node, None)]
+    while stack:
+        el, children = stack.pop()
+        if children is None:
+            if isinstance(el.tag, basestring):
+                yield ('start', el.tag, el.attrib, el)
+                if el.text:
+                    yield ('text', el.text)
+                stack.append((el, iter(el)))
+            elif el.tail and el is not node:
+                yield ('text', el.tail)
+            continue
+        for child in children:
+            stack.append((el, children))
+            stack.append((child, None))
+            break
+        else:
+            yield ('end', el.tag)
+            if el.tail and el is not node:
+                yield ('text', el.tail)
+
+class TableSchema(object):
+    '''Declarative description of rows to pull out of tables, compiled
+    once and applied to any number of pages in a single tree walk.
+
+    Each container element found gives a group (title, rows).  A row is
+    a tuple of the stripped text of its cells followed by the attribute
+    values captured from the row.
+    '''
+
+    def __init__(self, container=None, title=None, table=None, row='tr',
+                 cell='td', max_cells=None, attrs=(), pairs=False):
+        '''
+        Selectors are as for region_strainer().
+        :param container: Elements holding one table each, or None for
+            the whole tree as a single group
+        :param title: Element within a container whose text titles the group
+        :param table: Element within a container holding the rows, or None
+        :param row: Row elements
+        :param cell: Cell elements within a row, or None to take no text
+        :param max_cells: Keep only this many leading cells of each row
+        :param attrs: List of (selector, attribute); for each, the attribute
+            of the first matching element in the row is captured
+        :param pairs: If True, each group's rows become a dict mapping the
+            first cell to the second, for rows with a non-empty first cell
+        '''
+        self.container = container and region_matcher([container])
+        self.title = title and region_matcher([title])
+        self.table = table and region_matcher([table])
+        self.row = region_matcher([row])
+        self.cell = cell and region_matcher([cell])
+        self.max_cells = max_cells
+        self.attrs = [(region_matcher([sel]), name) for sel, name in attrs]
+        self.pairs = pairs
+
+    def extract(self, doc):
+        '''Return a list of (title, rows) groups from a parse tree'''
+        groups = []
+        depth = 0
+        group = title = table = row = cell = None   # depth when entered
+        rows = cells = captured = None
+        title_text = []
+        for event in walk(doc):
+            kind = event[0]
+            if kind == 'text':
+                if cell is not None:
+                    cells[-1].append(event[1])
+                elif title is not None:
+                    title_text.append(event[1])
+                continue
+            if kind == 'end':
+                depth -= 1
+                if depth == cell:
+                    cell = None
+                elif depth == row:
+                    row = None
+                    rows.append(tuple([u''.join(c).strip() for c in cells]
+                                      + captured))
+                elif depth == title:
+                    title = None
+                elif depth == table:
+                    table = None
+                elif depth == group:
+                    group = None
+                    groups.append((u''.join(title_text).strip() or None,
+                                   rows))
+                continue
+            name, attrs = event[1], event[2]
+            if group is None:
+                if self.container is None or self.container(name, attrs):
+                    group = depth
+                    rows = []
+                    title_text = []
+            elif row is not None:
+                if (cell is None and self.cell is not None
+                    and self.cell(name, attrs)
+                    and (self.max_cells is None
+                         or len(cells) < self.max_cells)):
+                    cell = depth
+                    cells.append([])
+                for i, (match, attr) in enumerate(self.attrs):
+                    if captured[i] is None and match(name, attrs):
+                        captured[i] = dict(attrs).get(attr, u'')
+            elif self.table is not None and table is None:
+                if self.table(name, attrs):
+                    table = depth
+                elif (self.title is not None and title is None
+                      and not title_text and self.title(name, attrs)):
+                    title = depth
+            elif self.row(name, attrs):
+                row = depth
+                cells = []
+                captured = [None] * len(self.attrs)
+            elif (self.title is not None and title is None
+                  and not title_text and self.title(name, attrs)):
+                title = depth
+            depth += 1
+        if group is not None:
+            groups.append((u''.join(title_text).strip() or None, rows))
+        if self.pairs:
+            groups = [(t, dict(r[:2] for r in grows if len(r) >= 2 and r[0]))
+                      for t, grows in groups]
+        return groups
+
+class Field(object):
+    '''A control of an HTML form'''
+    __slots__ = ('name', 'type', 'value', 'checked', 'disabled', 'options')
+
+    def __init__(self, name, type, value=u'', checked=False, disabled=False,
+                 options=None):
+        self.name = name
+        self.type = type
+        self.value = value
+        self.checked = checked
+        self.disabled = disabled
+        self.options = options      # <select> option values
+
+    def __repr__(self):
+        return 'Field(%r, %r, %r)' % (self.name, self.type, self.value)
+
+    def successful(self):
+        '''Whether the field is submitted with the form'''
+        if (self.disabled or self.value is None
+            or self.type in _unsubmitted_types):
+            return False
+        if self.type in ('checkbox', 'radio'):
+            return self.checked
+        return True
+
+_unsubmitted_types = frozenset(('submit', 'reset', 'button', 'image', 'file'))
+
+class Form(object):
+    '''Fields of an HTML form, collected in one walk of its tree.
+      fields  Field objects in document order
+      index   dict, key=name, value=list of Fields with that name
+    '''
+
+    def __init__(self, fields=(), action=None, method='get'):
+        self.action = action
+        self.method = method
+        self.fields = []
+        self.index = {}
+        for field in fields:
+            self.add(field)
+
+    def add(self, field):
+        self.fields.append(field)
+        self.index.setdefault(field.name, []).append(field)
+
+    @classmethod
+    def from_element(cls, element):
+        '''Collect the <input>, <select> and <textarea> fields inside an
+        element, usually a <form>, from a BeautifulSoup or lxml tree'''
+        attrs = dict(element.attrs if hasattr(element, 'findAll')
+                     else element.attrib)
+        self = cls(action=attrs.get('action'),
+                   method=(attrs.get('method') or 'get').lower())
+        select = textarea = None
+        text = []
+        for event in walk(element):
+            kind = event[0]
+            if kind == 'text':
+                if textarea is not None:
+                    text.append(event[1])
+                continue
+            if kind == 'end':
+                if event[1] == 'select' and select is not None:
+                    if select.value is None and select.options:
+                        select.value = select.options[0]
+                    select = None
+                elif event[1] == 'textarea' and textarea is not None:
+                    textarea.value = u''.join(text)
+                    textarea = None
+                continue
+            name, attrs = event[1], event[2]
+            if name not in _form_tags:
+                continue
+            if not isinstance(attrs, dict):
+                attrs = dict(attrs)
+            if name == 'option':
+                if select is not None:
+                    value = attrs.get('value', u'')
+                    select.options.append(value)
+                    if 'selected' in attrs:
+                        select.value = value
+                continue
+            if 'name' not in attrs:
+                continue
+            disabled = 'disabled' in attrs
+            if name == 'input':
+                type = (attrs.get('type') or 'text').lower()
+                default = u'on' if type in ('checkbox', 'radio') else u''
+                self.add(Field(attrs['name'], type, attrs.get('value', default),
+                               checked='checked' in attrs, disabled=disabled))
+            elif name == 'select':
+                select = Field(attrs['name'], 'select', None,
+                               disabled=disabled, options=[])
+                self.add(select)
+            else:
+                textarea = Field(attrs['name'], 'textarea', disabled=disabled)
+                text = []
+                self.add(textarea)
+        return self
+
+    def __getitem__(self, name):
+        '''First field with the given name'''
+        return self.index[name][0]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name, default=None):
+        '''Value of the first field with the given name'''
+        if name in self.index:
+            return self.index[name][0].value
+        return default
+
+    def group(self, pattern):
+        '''Group fields whose names match a regex with two groups,
+        e.g. r'grid_1_(\d+)_(\w+)' for grid_1_<n>_<column>.
+        Return a dict, key=first group, value=dict of second group -> Field.
+        '''
+        regex = re.compile(pattern)
+        groups = {}
+        for name, fields in self.index.items():
+            m = regex.match(name)
+            if m:
+                row, col = m.groups()
+                groups.setdefault(row, {})[col] = fields[0]
+        return groups
+
+    def query(self, values=()):
+        '''List of (name, value) pairs to submit, e.g. with PageSource.post.
+        :param values: (name, value) pairs or a dict; these replace all
+            values of the form for the same names
+        '''
+        if isinstance(values, dict):
+            values = values.items()
+        values = list(values)
+        replaced = set(name for name, value in values)
+        query = [(f.name, f.value) for f in self.fields
+                 if f.name not in replaced and f.successful()]
+        query.extend(values)
+        return [(_utf8(name), _utf8(value)) for name, value in query]
+
+_form_tags = frozenset(('input', 'select', 'option', 'textarea'))
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
 
 if __name__=='__main__':
     import argparse
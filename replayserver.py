@@ -0,0 +1,320 @@
+#=======================================================================
+#       Stand-in HTTP server replaying a recorded page cache
+#
+# serve: answer requests from the pages in a PageSource cache directory,
+#        with optional latency and bandwidth shaping, and emulate the
+#        login cookie flow of a site profile (tg582n, myrec).
+# bench: run the server in-process and drive Modem, MyRec or plain
+#        PageSource clients against it at several concurrency levels,
+#        reporting throughput and latency percentiles.
+#=======================================================================
+from ptscrape import PageCache, PageSource
+import BaseHTTPServer
+import SocketServer
+import itertools
+import logging
+import mimetools
+import os
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from urlparse import urlparse
+
+_log = logging.getLogger(__name__)
+
+# login: request which logs in and gets a session cookie
+# login_page: path suffix of the page shown to clients without a session
+PROFILES = {
+    'tg582n': dict(login=('POST', '/login.lp'), login_page='/login.lp'),
+    'myrec': dict(login=('POST', '/j_security_check'), login_page='/main/'),
+    }
+
+SESSION_COOKIE = 'replay_session'
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server answering from the pages recorded in a cache directory.
+    Where one URL was recorded several times (e.g. before and after
+    login), clients with a session get the latest recording and others
+    the earliest.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, cachedir, profile=None, latency=0.0,
+                 bandwidth=None):
+        '''
+        :param address: (host, port) to listen on
+        :param cachedir: PageSource cache directory to replay
+        :param profile: Name of the login flow to emulate; see PROFILES
+        :param latency: Seconds to wait before each response
+        :param bandwidth: Bytes per second for response bodies, or None
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.profile = PROFILES[profile] if profile else None
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.pages = {}         # (method, path?query) -> [response]
+        self.login_page = None
+        self._sessions = set()
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self.load(cachedir)
+
+    def load(self, cachedir):
+        '''Read every recorded response into memory'''
+        # Serving must not change the recording
+        cache = PageCache(cachedir, max_bytes=None, readonly=True)
+        try:
+            for key, method, url, status, headers, stored in cache.index():
+                entry = cache.get(key)
+                if entry is None or url is None:
+                    continue
+                u = urlparse(url)
+                target = u.path + ('?' + u.query if u.query else '')
+                msg = mimetools.Message(StringIO(headers or ''))
+                response = (status or 200,
+                            msg.getheader('content-type', 'text/html'),
+                            entry.content)
+                self.pages.setdefault((method, target), []).append(response)
+                if (self.profile and self.login_page is None
+                    and method == 'GET'
+                    and u.path.endswith(self.profile['login_page'])):
+                    self.login_page = response
+        finally:
+            cache.close()
+        _log.info('loaded %d recorded URLs', len(self.pages))
+
+    def lookup(self, method, target, cookie):
+        '''Return (response or None, new session id or None)'''
+        authed = self._has_session(cookie)
+        session = None
+        path = target.split('?', 1)[0]
+        if self.profile:
+            login_method, login_path = self.profile['login']
+            if method == login_method and path.endswith(login_path):
+                with self._lock:
+                    session = str(next(self._counter))
+                    self._sessions.add(session)
+                authed = True
+            elif (not authed and self.login_page
+                  and not path.endswith(self.profile['login_page'])):
+                return self.login_page, None
+        variants = self.pages.get((method, target))
+        if not variants:
+            return None, session
+        return (variants[-1] if authed else variants[0]), session
+
+    def _has_session(self, cookie):
+        if not cookie:
+            return False
+        for part in cookie.split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == SESSION_COOKIE and value in self._sessions:
+                return True
+        return False
+
+    def expire_sessions(self):
+        '''Forget all sessions, so clients must log in again'''
+        with self._lock:
+            self._sessions.clear()
+
+    def send_body(self, wfile, content):
+        if not self.bandwidth:
+            wfile.write(content)
+            return
+        chunk = max(1024, int(self.bandwidth / 20))
+        for i in range(0, len(content), chunk):
+            part = content[i:i+chunk]
+            wfile.write(part)
+            wfile.flush()
+            time.sleep(len(part) / float(self.bandwidth))
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body together, so latency is only what we add
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._replay('GET')
+
+    def do_POST(self):
+        self._replay('POST')
+
+    def _replay(self, method):
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        server = self.server
+        response, session = server.lookup(method, self.path,
+                                          self.headers.getheader('cookie'))
+        if server.latency:
+            time.sleep(server.latency)
+        if response is None:
+            status, ctype, content = 404, 'text/plain', 'Not recorded\n'
+        else:
+            status, ctype, content = response
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(content)))
+        if session:
+            self.send_header('Set-Cookie',
+                             '%s=%s; Path=/' % (SESSION_COOKIE, session))
+        self.end_headers()
+        server.send_body(self.wfile, content)
+
+    def log_message(self, format, *args):
+        _log.debug(format, *args)
+
+#-----------------------------------------------------------------------
+#       Load generation
+#-----------------------------------------------------------------------
+def run_load(make_client, concurrency, iterations):
+    '''Run iterations operations in each of concurrency threads.
+    :param make_client: Called once per thread; returns a callable which
+        performs one operation, and may have a close() method
+    Return dict of count, errors, elapsed, throughput and latency
+    percentiles in seconds.
+    '''
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    def worker():
+        op = make_client()
+        mine = []
+        failed = 0
+        for i in range(iterations):
+            start = time.time()
+            try:
+                op()
+            except Exception:
+                _log.debug('operation failed', exc_info=True)
+                failed += 1
+                continue
+            mine.append(time.time() - start)
+        if hasattr(op, 'close'):
+            op.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    result = dict(concurrency=concurrency, count=len(latencies),
+                  errors=errors[0], elapsed=elapsed,
+                  throughput=len(latencies) / elapsed if elapsed else 0.0)
+    for p in (50, 90, 99):
+        result['p%d' % p] = percentile(latencies, p)
+    return result
+
+def percentile(ordered, p):
+    '''p-th percentile of a sorted list, by nearest rank'''
+    if not ordered:
+        return None
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+def modem_client(url, authfile):
+    '''Client polling broadband usage, logging in once'''
+    from tg582n import Modem
+    def make():
+        modem = Modem(url, authfile, cachedir=None)
+        def op():
+            modem.ensure_login()
+            page = modem.get_broadband_page()
+            modem.get_broadband_usage(page)
+        op.close = modem.source.close
+        return op
+    return make
+
+def myrec_client(url, authfile, org):
+    '''Client logging in and fetching all pending timesheets each time'''
+    from myrec import MyRec
+    def make():
+        def op():
+            rec = MyRec(org, authfile, cachedir=None)
+            rec.baseurl = '%s/%s/' % (url, org)
+            try:
+                rec.fetch_timesheets(sorted(rec.get_timesheet_links()))
+            finally:
+                rec.source.close()
+        return op
+    return make
+
+def page_client(url, targets):
+    '''Client fetching the recorded GET URLs in turn'''
+    def make():
+        source = PageSource()
+        cycle = itertools.cycle(targets)
+        def op():
+            source.get(url + next(cycle))
+        op.close = source.close
+        return op
+    return make
+
+if __name__=='__main__':
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--verbose', '-v', action='store_true')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', '-p', type=int, default=8080)
+    ap.add_argument('--profile', choices=sorted(PROFILES))
+    ap.add_argument('--latency', type=float, default=0.0,
+                    help='Seconds before each response')
+    ap.add_argument('--bandwidth', type=float,
+                    help='Response bytes per second')
+    ap.add_argument('action', choices=('serve', 'bench'))
+    ap.add_argument('cachedir')
+    ap.add_argument('--client', choices=('modem', 'myrec', 'page'),
+                    default='page', help='Client driven by bench')
+    ap.add_argument('--org', default='ccfe_prod',
+                    help='MyRecruiter organisation for the myrec client')
+    ap.add_argument('--concurrency', default='1,4,16',
+                    help='Comma-separated concurrency levels for bench')
+    ap.add_argument('--iterations', '-n', type=int, default=20,
+                    help='Operations per client thread')
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    server = ReplayServer((args.host, args.port), args.cachedir,
+                          args.profile, args.latency, args.bandwidth)
+    if args.action == 'serve':
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://%s:%d' % server.server_address
+        fd, authfile = tempfile.mkstemp()
+        os.write(fd, 'replay:replay\n')
+        os.close(fd)
+        try:
+            if args.client == 'modem':
+                make = modem_client(url, authfile)
+            elif args.client == 'myrec':
+                make = myrec_client(url, authfile, args.org)
+            else:
+                make = page_client(url, sorted(
+                    target for method, target in server.pages
+                    if method == 'GET'))
+            print '%11s %8s %6s %8s %8s %8s %8s' % (
+                'concurrency', 'ops', 'errors', 'ops/s',
+                'p50 ms', 'p90 ms', 'p99 ms')
+            for level in [int(c) for c in args.concurrency.split(',')]:
+                r = run_load(make, level, args.iterations)
+                ms = tuple('-' if r[p] is None else '%.1f' % (r[p] * 1e3)
+                           for p in ('p50', 'p90', 'p99'))
+                print '%11d %8d %6d %8.1f %8s %8s %8s' % (
+                    (level, r['count'], r['errors'], r['throughput']) + ms)
+        finally:
+            os.unlink(authfile)
+            server.shutdown()
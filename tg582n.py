@@ -1,12 +1,32 @@
-from ptscrape import PageSource, soup, bs_cdata
+from ptscrape import PageSource, TableSchema, Form, Metrics, ExtractCache, \
+     extractor, page_title, soup, bs_cdata
+from usagestore import UsageStore, FIELDS
 from hashlib import md5
+import logging
 import os
+import random
 import re
+import threading
+import time
+
+_log = logging.getLogger(__name__)
 
 class Modem(object):
-    def __init__(self, url, authfile, cachedir='~/var/modem', replay=False):
+    # Label/value pairs from the datatable in each titled div.contentitem
+    usage_schema = TableSchema(container='div.contentitem',
+                               title='span.itemtitle',
+                               table='table.datatable',
+                               max_cells=2, pairs=True)
+
+    def __init__(self, url, authfile, cachedir='~/var/modem', replay=False,
+                 sessionfile=None, metrics=None, memo=None, scheduler=None,
+                 timeout=None):
         self.url = url
-        self.source = PageSource(cachedir=cachedir, replay=replay)
+        self.logged_in = False
+        self.source = PageSource(cachedir=cachedir, replay=replay,
+                                 session=sessionfile, metrics=metrics,
+                                 memo=memo, scheduler=scheduler,
+                                 timeout=timeout)
         f = open(os.path.expanduser(authfile))
         try:
             self.user, self.password = f.readline().rstrip().split(':')
@@ -20,13 +40,24 @@ class Modem(object):
         params = self.build_login_query(page)
         home = self.source.post(self.url+'/login.lp', query=params,
                                 tag='home')
-        assert bs_cdata(home.doc.find('title')).endswith(' Home')
+        assert page_title(home).endswith(' Home')
+        self.logged_in = True
+        self.source.mark_session_valid()
         return home
 
+    def ensure_login(self):
+        '''Log in unless already logged in or a stored session is valid'''
+        if not (self.logged_in or self.source.session_valid()):
+            self.login()
+
+    def is_login_page(self, page):
+        '''Whether the modem sent its login page, i.e. the session expired'''
+        return page_title(page).endswith(' Login')
+
     def get_login_page(self):
         page = self.source.get(self.url+'/login.lp',
                                tag='login')
-        assert bs_cdata(page.doc.find('title')).endswith(' Login')
+        assert page_title(page).endswith(' Login')
         return page
 
     def build_login_query(self, page):
@@ -41,9 +72,9 @@ class Modem(object):
         hidepw=(calculated md5hex)
         user=admin
         '''
-        form = page.doc.find('form', {'name':'authform'})
+        form = Form.from_element(page.doc.find('form', {'name':'authform'}))
         query = {}
-        query['rn'] = form.find('input', {'name':'rn'})['value']
+        query['rn'] = form.get('rn')
         query['user'] = self.user
         script = bs_cdata(page.doc.find('script'))
         #print script
@@ -71,29 +102,21 @@ class Modem(object):
         return query
 
     def get_broadband_page(self):
-        page = self.source.get(self.url+'/cgi/b/bb/?be=0&l0=2&l1=-1',
-                               tag='bb')
-        assert bs_cdata(page.doc.find('title')).endswith(' Broadband Connection')
+        url = self.url+'/cgi/b/bb/?be=0&l0=2&l1=-1'
+        page = self.source.get(url, tag='bb', only=['div.contentitem'])
+        if self.is_login_page(page):
+            _log.info('session expired, logging in')
+            self.logged_in = False
+            self.source.invalidate_session()
+            self.login()
+            page = self.source.get(url, tag='bb', only=['div.contentitem'])
+        assert page_title(page).endswith(' Broadband Connection')
+        self.source.mark_session_valid()
         return page
 
+    @extractor('tg582n.broadband_usage')
     def get_broadband_usage(self, page):
-        raw = {}
-        #blocks = page.doc.find_all('div', {'class':'contentitem'})
-        blocks = page.doc.findAll('div', {'class':'contentitem'})
-        for div in blocks:
-            itemtitle = bs_cdata(div.find('span', {'class':'itemtitle'})).strip()
-            lraw = raw[itemtitle] = {}
-            datatable = div.find('table', {'class':'datatable'})
-            #rows = datatable.find_all('tr')
-            rows = datatable.findAll('tr')
-            for tr in rows:
-                #tds = tr.find_all('td')[:2]
-                tds = tr.findAll('td')[:2]
-                if len(tds) == 2:
-                    desc = bs_cdata(tds[0]).strip()
-                    value = bs_cdata(tds[1]).strip()
-                    if desc:
-                        lraw[desc] = value
+        raw = dict(self.usage_schema.extract(page.doc))
         #print raw
         usage = {}
         for nkey,ntitle in (('dsl','DSL Connection'),('inet','Internet')):
@@ -107,12 +130,14 @@ class Modem(object):
         return usage
 
     def get_broadband_usage_string(self, page):
-        usage = self.get_broadband_usage(page)
-        vals = []
-        for net, props in sorted(usage.items()):
-            for key, value in sorted(props.items()):
-                vals.append('%s.%s=%.2f' % (net, key, value))
-        return ' '.join(vals)
+        return usage_string(self.get_broadband_usage(page))
+
+def usage_string(usage):
+    vals = []
+    for net, props in sorted(usage.items()):
+        for key, value in sorted(props.items()):
+            vals.append('%s.%s=%.2f' % (net, key, value))
+    return ' '.join(vals)
 
 def txrx_gb(label,values):
     m = re.match('Data Transferred.*\[(\w+)/(\w+)\]', label)
@@ -140,6 +165,272 @@ def scale_GB(num, unit):
 def md5hex(string):
     return md5(string).hexdigest()
 
+def syslog_sink(ident='bbmodem'):
+    '''Sink writing usage strings to syslog, as logger(1) would'''
+    import syslog
+    syslog.openlog(ident)
+    return syslog.syslog
+
+def stdout_sink(text):
+    print time.strftime('%Y-%m-%dT%H:%M:%S'), text
+
+class Poller(object):
+    '''Sample broadband usage at a fixed interval with one long-lived Modem.
+    Login happens only when the modem session has expired.
+      samples   successful samples
+      errors    failed samples
+      overruns  samples which took longer than the interval
+      missed    interval slots skipped because a sample overran
+    '''
+
+    def __init__(self, modem, sink, interval=60.0, jitter=0.0, store=None):
+        '''
+        :param modem: Modem to sample
+        :param sink: Callable taking each usage string
+        :param interval: Seconds between samples
+        :param jitter: Maximum random delay in seconds added to each sample
+        :param store: UsageStore to append each sample to
+        '''
+        self.modem = modem
+        self.sink = sink
+        self.store = store
+        self.interval = interval
+        self.jitter = jitter
+        self.samples = self.errors = self.overruns = self.missed = 0
+
+    def sample(self):
+        self.modem.ensure_login()
+        page = self.modem.get_broadband_page()
+        usage = self.modem.get_broadband_usage(page)
+        page.release()
+        if self.store is not None:
+            self.store.append(usage)
+        self.sink(usage_string(usage))
+
+    def run(self, count=None):
+        '''Sample until count samples have been attempted, or forever'''
+        slot = time.time()
+        n = 0
+        while count is None or n < count:
+            start = time.time()
+            try:
+                self.sample()
+                self.samples += 1
+            except Exception:
+                _log.exception('sample failed')
+                self.errors += 1
+                self.modem.logged_in = False
+            n += 1
+            elapsed = time.time() - start
+            if elapsed > self.interval:
+                self.overruns += 1
+                _log.warning('sample took %.1fs, over interval of %.1fs',
+                             elapsed, self.interval)
+            slot += self.interval
+            now = time.time()
+            if now > slot:
+                missed = int((now - slot) // self.interval) + 1
+                self.missed += missed
+                slot += missed * self.interval
+                _log.warning('missed %d sample interval(s)', missed)
+            if count is None or n < count:
+                time.sleep(slot - now + random.uniform(0, self.jitter))
+
+    def stats(self):
+        return dict(samples=self.samples, errors=self.errors,
+                    overruns=self.overruns, missed=self.missed)
+
+#-----------------------------------------------------------------------
+#       Fleets of modems
+#-----------------------------------------------------------------------
+def read_inventory(path, auth='~/.adsl.auth',
+                   cachedir='~/var/modem/fleet/%(host)s',
+                   session='~/var/modem/fleet/%(host)s/session'):
+    '''Read a fleet inventory file.  Each line names a modem host,
+    optionally followed by settings for it:
+      url=URL       base URL; default http://HOST
+      auth=FILE     user:password file
+      cache=DIR     page cache directory
+      session=FILE  session file
+    Blank lines and text after # are ignored.  %(host)s in the defaults
+    is replaced by the host name.
+    Return list of dicts with keys host, url, auth, cachedir, session.
+    '''
+    devices = []
+    with open(os.path.expanduser(path)) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            host = fields[0]
+            device = dict(host=host, url='http://' + host,
+                          auth=auth % dict(host=host),
+                          cachedir=cachedir % dict(host=host),
+                          session=session % dict(host=host))
+            for field in fields[1:]:
+                key, sep, value = field.partition('=')
+                key = dict(cache='cachedir').get(key, key)
+                if not sep or key not in device or key == 'host':
+                    raise ValueError('%s:%d: bad setting %r'
+                                     % (path, lineno, field))
+                device[key] = value
+            devices.append(device)
+    return devices
+
+def total_usage(usages):
+    '''Sum usage dicts from get_broadband_usage() per network and key'''
+    total = {}
+    for usage in usages:
+        for net, props in usage.items():
+            ntotal = total.setdefault(net, {})
+            for key, value in props.items():
+                ntotal[key] = ntotal.get(key, 0.0) + value
+    return total
+
+class Fleet(object):
+    '''Sample broadband usage from many modems at once.
+    Modems are kept between sweeps, so each logs in only when its session
+    has expired.  All share one Scheduler, which keeps a rate limit and
+    circuit breaker per host, so dead devices fail fast on later sweeps.
+    '''
+
+    def __init__(self, devices, concurrency=32, timeout=10.0, replay=False,
+                 metrics=None, memo=None, scheduler=None):
+        '''
+        :param devices: Dicts from read_inventory()
+        :param concurrency: Maximum devices sampled at once
+        :param timeout: Seconds allowed for each device; also the socket
+            timeout of each request
+        :param scheduler: pthttp.Scheduler for all requests; default one
+            retrying once
+        '''
+        if scheduler is None:
+            from pthttp import Scheduler
+            scheduler = Scheduler(retries=1)
+        self.devices = devices
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.replay = replay
+        self.metrics = metrics
+        self.memo = memo
+        self.scheduler = scheduler
+        self.modems = {}        # host -> Modem
+        self._lock = threading.Lock()
+
+    def modem(self, device):
+        '''Modem for a device, created on first use'''
+        with self._lock:
+            modem = self.modems.get(device['host'])
+            if modem is None:
+                modem = Modem(device['url'], device['auth'],
+                              cachedir=device['cachedir'],
+                              replay=self.replay,
+                              sessionfile=device['session'],
+                              metrics=self.metrics, memo=self.memo,
+                              scheduler=self.scheduler, timeout=self.timeout)
+                self.modems[device['host']] = modem
+            return modem
+
+    def sample(self, modem):
+        try:
+            modem.ensure_login()
+            page = modem.get_broadband_page()
+            usage = modem.get_broadband_usage(page)
+            page.release()
+        except Exception:
+            modem.logged_in = False
+            raise
+        return usage
+
+    def sweep(self):
+        '''Sample every device once.  A device still running after timeout
+        seconds is abandoned, and its worker thread replaced.
+        Return list of dicts in inventory order, with keys host, usage
+        (None on failure), error (message, or None) and seconds.
+        '''
+        import Queue
+        jobs = Queue.Queue()
+        for job in enumerate(self.devices):
+            jobs.put(job)
+        done = Queue.Queue()
+        running = {}            # index -> start time
+        def worker():
+            while True:
+                try:
+                    i, device = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                with self._lock:
+                    running[i] = start
+                modem = None
+                try:
+                    modem = self.modem(device)
+                    usage, error = self.sample(modem), None
+                except Exception, e:
+                    _log.info('%s failed: %s', device['host'], e)
+                    usage, error = None, str(e) or type(e).__name__
+                with self._lock:
+                    abandoned = running.pop(i, None) is None
+                    if abandoned and modem is not None:
+                        if self.modems.get(device['host']) is modem:
+                            del self.modems[device['host']]
+                if abandoned:
+                    # A replacement thread has taken this one's place
+                    if modem is not None:
+                        self._close(modem)
+                    return
+                done.put((i, usage, error, time.time() - start))
+        def spawn():
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        for n in range(min(self.concurrency, len(self.devices))):
+            spawn()
+        results = [None] * len(self.devices)
+        remaining = len(self.devices)
+        while remaining:
+            wait = self.timeout
+            with self._lock:
+                now = time.time()
+                for i, start in running.items():
+                    if now - start < self.timeout:
+                        wait = min(wait, start + self.timeout - now)
+                        continue
+                    del running[i]
+                    host = self.devices[i]['host']
+                    _log.warning('%s timed out after %.1fs', host,
+                                 now - start)
+                    # The stuck thread still uses its Modem, and closes it
+                    self.modems.pop(host, None)
+                    results[i] = dict(host=host, usage=None,
+                                      error='timed out', seconds=now - start)
+                    remaining -= 1
+                    spawn()
+            if not remaining:
+                break
+            try:
+                i, usage, error, seconds = done.get(timeout=max(wait, 0.01))
+            except Queue.Empty:
+                continue
+            results[i] = dict(host=self.devices[i]['host'], usage=usage,
+                              error=error, seconds=seconds)
+            remaining -= 1
+        return results
+
+    def _close(self, modem):
+        '''Close a Modem, leaving the shared memo open'''
+        modem.source.memo = None
+        modem.source.close()
+
+    def close(self):
+        with self._lock:
+            for modem in self.modems.values():
+                self._close(modem)
+            self.modems.clear()
+        if self.memo:
+            self.memo.close()
+
 if __name__=='__main__':
     import argparse
     import logging
@@ -150,6 +441,16 @@ if __name__=='__main__':
                     help='Hostname of modem')
     ap.add_argument('--replay', '-r', action='store_true',
                     help='Use cached pages rather than making web queries')
+    ap.add_argument('--session', '-s', default='~/var/modem/session',
+                    help='File to keep the login session in between runs')
+    ap.add_argument('--store', default='~/var/modem/usage.dat',
+                    help='Sample store for log-usage, poll and rates;'
+                    ' not written with --replay')
+    ap.add_argument('--metrics', metavar='FILE',
+                    help='Write request timing metrics to FILE on exit')
+    ap.add_argument('--memo', metavar='FILE',
+                    help='Keep extracted data in FILE, to skip parsing'
+                    ' pages seen before')
     sp = ap.add_subparsers(dest='action', metavar='ACTION',
                            help='Action to perform')
     a_login = sp.add_parser('login',
@@ -160,29 +461,102 @@ if __name__=='__main__':
                             help='Show broadband usage')
     a_log_usage = sp.add_parser('log-usage',
                                 help='Record broadband usage in syslog')
+    a_rates = sp.add_parser('rates',
+                            help='Show throughput from the sample store')
+    a_rates.add_argument('--step', type=float, default=3600,
+                         help='Seconds per row')
+    a_rates.add_argument('--hours', type=float, default=24,
+                         help='Show this many hours back from now')
+    a_poll = sp.add_parser('poll',
+                           help='Keep recording broadband usage at intervals')
+    a_poll.add_argument('--interval', '-i', type=float, default=60,
+                        help='Seconds between samples')
+    a_poll.add_argument('--jitter', '-j', type=float, default=0,
+                        help='Maximum random delay added to each sample')
+    a_poll.add_argument('--count', '-n', type=int,
+                        help='Stop after this many samples')
+    a_poll.add_argument('--stdout', action='store_true',
+                        help='Print samples instead of sending them to syslog')
+    a_fleet = sp.add_parser('fleet',
+                            help='Show broadband usage of every modem in'
+                            ' an inventory file, and the total')
+    a_fleet.add_argument('inventory',
+                         help='File with a line per modem: HOST'
+                         ' [url=URL] [auth=FILE] [cache=DIR] [session=FILE]')
+    a_fleet.add_argument('--concurrency', '-c', type=int, default=32,
+                         help='Maximum modems queried at once')
+    a_fleet.add_argument('--timeout', '-t', type=float, default=10,
+                         help='Seconds allowed for each modem')
     args = ap.parse_args()
     level = (logging.INFO if args.verbose else
              logging.WARNING)
     logging.basicConfig(level=level)
-    modem = Modem('http://'+args.host, '~/.adsl.auth',
-                  replay=args.replay)
+    metrics = Metrics() if args.metrics else None
+    memo = ExtractCache(args.memo) if args.memo else None
+    # rates only reads the sample store; fleet makes its own Modems
+    if args.action not in ('rates', 'fleet'):
+        modem = Modem('http://'+args.host, '~/.adsl.auth',
+                      replay=args.replay, sessionfile=args.session,
+                      metrics=metrics, memo=memo)
 
     if args.action == 'login':
         modem.login()
     elif args.action == 'broadband':
-        modem.login()
+        modem.ensure_login()
         page = modem.get_broadband_page()
         usage = modem.get_broadband_usage(page)
     elif args.action == 'usage':
-        modem.login()
+        modem.ensure_login()
         page = modem.get_broadband_page()
         text = modem.get_broadband_usage_string(page)
         print text
     elif args.action == 'log-usage':
-        modem.login()
+        modem.ensure_login()
         page = modem.get_broadband_page()
-        text = modem.get_broadband_usage_string(page)
-        import subprocess
-        subprocess.call(['logger','-t','bbmodem',text])
+        usage = modem.get_broadband_usage(page)
+        # Replayed usage is not a sample of now, so keep it out of the store
+        if not args.replay:
+            UsageStore(args.store).append(usage)
+        syslog_sink()(usage_string(usage))
+    elif args.action == 'rates':
+        store = UsageStore(args.store)
+        starts, totals, rates = store.rollup(
+            args.step, start=time.time() - args.hours * 3600)
+        print '%-19s %s' % ('time', ' '.join('%10s' % f for f in FIELDS))
+        for t, row in zip(starts, rates):
+            print '%-19s %s' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)),
+                ' '.join('%6.2fMb/s' % (r * 8e3) for r in row))
+    elif args.action == 'poll':
+        sink = stdout_sink if args.stdout else syslog_sink()
+        poller = Poller(modem, sink, args.interval, args.jitter,
+                        store=None if args.replay else UsageStore(args.store))
+        try:
+            poller.run(args.count)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            modem.source.close()
+        _log.info('poller stats %r', poller.stats())
+    elif args.action == 'fleet':
+        fleet = Fleet(read_inventory(args.inventory), args.concurrency,
+                      args.timeout, replay=args.replay, metrics=metrics,
+                      memo=memo)
+        start = time.time()
+        try:
+            results = fleet.sweep()
+        finally:
+            fleet.close()
+        for r in results:
+            print '%-24s %s' % (r['host'], usage_string(r['usage'])
+                                if r['error'] is None
+                                else 'ERROR ' + r['error'])
+        good = [r['usage'] for r in results if r['error'] is None]
+        print '%-24s %s' % ('total', usage_string(total_usage(good)))
+        _log.info('%d of %d modems in %.1fs', len(good), len(results),
+                  time.time() - start)
     else:
         raise ValueError('Unknown action %r' % args.action)
+    if metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.dump())
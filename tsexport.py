@@ -0,0 +1,192 @@
+#=======================================================================
+#       Bulk export and loading of timesheets
+#
+# Formats, chosen by file extension:
+#   .csv    one row per job type or allowance of each timesheet:
+#           sheet, name, company, enddate, type (STD|OVT|ALW), code, d1..d7
+#   .jsonl  one JSON object per timesheet
+#   .npz    numpy arrays: per-sheet name, company and enddate; the hours
+#           of every job as one [job, STD/OVT, day] matrix, and the
+#           allowances as a [allowance, day] matrix, each row tagged with
+#           the index of its sheet.  Needs numpy.
+#=======================================================================
+from myrec import Timesheet
+import csv
+import json
+import os
+
+FORMATS = ('csv', 'jsonl', 'npz')
+BUFSIZE = 1 << 16
+DAYS = ['d%d' % d for d in range(1, 8)]
+
+def export(timesheets, path, format=None):
+    '''Write timesheets to a file.
+    :param format: One of FORMATS; default from the file extension
+    Return the number of timesheets written.
+    '''
+    format = format or _format(path)
+    if format == 'npz':
+        return _export_npz(list(timesheets), path)
+    with open(path, 'wb', BUFSIZE) as f:
+        if format == 'csv':
+            return _export_csv(timesheets, f)
+        return _export_jsonl(timesheets, f)
+
+def load(path, format=None):
+    '''Read back a list of Timesheets written by export()'''
+    format = format or _format(path)
+    if format == 'npz':
+        return _load_npz(path)
+    with open(path, 'rb', BUFSIZE) as f:
+        if format == 'csv':
+            return _load_csv(f)
+        return _load_jsonl(f)
+
+def _format(path):
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    if ext not in FORMATS:
+        raise ValueError('Unknown export format %r; use one of %s'
+                         % (ext, ', '.join(FORMATS)))
+    return ext
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _sheet(name, company, enddate):
+    ts = Timesheet(enddate or None)
+    ts.name = name or None
+    ts.company = company or None
+    return ts
+
+#-----------------------------------------------------------------------
+#       CSV
+#-----------------------------------------------------------------------
+def _export_csv(timesheets, f):
+    out = csv.writer(f)
+    out.writerow(['sheet', 'name', 'company', 'enddate', 'type', 'code']
+                 + DAYS)
+    n = 0
+    for n, ts in enumerate(timesheets, 1):
+        head = [n - 1, _text(ts.name), _text(ts.company), _text(ts.enddate)]
+        for wbs, (std, ovt) in sorted(ts.jobs.items()):
+            out.writerow(head + ['STD', _text(wbs)] + map(repr, std))
+            out.writerow(head + ['OVT', _text(wbs)] + map(repr, ovt))
+        for code, days in sorted(ts.allowances.items()):
+            out.writerow(head + ['ALW', _text(code)] + map(repr, days))
+        if not ts.jobs and not ts.allowances:
+            # Keep empty weeks
+            out.writerow(head + ['', ''] + [''] * 7)
+    return n
+
+def _load_csv(f):
+    rows = csv.reader(f)
+    next(rows)
+    sheets = []
+    index = None
+    for row in rows:
+        if row[0] != index:
+            index = row[0]
+            ts = _sheet(*[v.decode('utf-8') for v in row[1:4]])
+            sheets.append(ts)
+        kind, code = row[4], row[5].decode('utf-8')
+        if kind == 'ALW':
+            ts.allowances[code] = [float(v) for v in row[6:13]]
+        elif kind:
+            job = ts.jobs.setdefault(code, [[0] * 7, [0] * 7])
+            job[kind == 'OVT'] = [float(v) for v in row[6:13]]
+    return sheets
+
+#-----------------------------------------------------------------------
+#       JSON Lines
+#-----------------------------------------------------------------------
+def _export_jsonl(timesheets, f):
+    n = 0
+    for n, ts in enumerate(timesheets, 1):
+        f.write(json.dumps(dict(name=ts.name, company=ts.company,
+                                enddate=ts.enddate and str(ts.enddate),
+                                jobs=ts.jobs, allowances=ts.allowances),
+                           separators=(',', ':')))
+        f.write('\n')
+    return n
+
+def _load_jsonl(f):
+    sheets = []
+    for line in f:
+        d = json.loads(line)
+        ts = _sheet(d['name'], d['company'], d['enddate'])
+        ts.jobs = d['jobs']
+        ts.allowances = d['allowances']
+        sheets.append(ts)
+    return sheets
+
+#-----------------------------------------------------------------------
+#       numpy
+#-----------------------------------------------------------------------
+def _export_npz(timesheets, path):
+    import numpy as np
+    wbs, hours, job_sheet = [], [], []
+    codes, allowances, alw_sheet = [], [], []
+    for i, ts in enumerate(timesheets):
+        w, h = ts.matrix()
+        wbs.extend(w)
+        hours.append(h)
+        job_sheet.extend([i] * len(w))
+        for code, days in sorted(ts.allowances.items()):
+            codes.append(code)
+            allowances.append(days)
+            alw_sheet.append(i)
+    def strings(values):
+        return np.array([v or u'' for v in values] or [u''], 'U')[:len(values)]
+    with open(path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            name=strings([ts.name for ts in timesheets]),
+            company=strings([ts.company for ts in timesheets]),
+            enddate=strings([ts.enddate and unicode(ts.enddate)
+                             for ts in timesheets]),
+            wbs=strings(wbs),
+            hours=(np.concatenate(hours) if hours
+                   else np.zeros((0, 2, 7))),
+            job_sheet=np.array(job_sheet, np.int32),
+            code=strings(codes),
+            allowances=np.array(allowances, float).reshape(-1, 7),
+            alw_sheet=np.array(alw_sheet, np.int32))
+    return len(timesheets)
+
+def _load_npz(path):
+    import numpy as np
+    data = np.load(path)
+    try:
+        sheets = [_sheet(*fields) for fields in
+                  zip(data['name'].tolist(), data['company'].tolist(),
+                      data['enddate'].tolist())]
+        # Rows are grouped by sheet, so split them at the index changes
+        for rows, table, key, matrix in (
+                ('job_sheet', 'jobs', 'wbs', 'hours'),
+                ('alw_sheet', 'allowances', 'code', 'allowances')):
+            owner = data[rows]
+            keys = data[key].tolist()
+            values = data[matrix].tolist()
+            bounds = np.searchsorted(owner, np.arange(len(sheets) + 1))
+            for i, ts in enumerate(sheets):
+                lo, hi = bounds[i], bounds[i + 1]
+                setattr(ts, table, dict(zip(keys[lo:hi], values[lo:hi])))
+    finally:
+        data.close()
+    return sheets
+
+if __name__=='__main__':
+    import argparse
+    ap = argparse.ArgumentParser(
+        description='Convert tasklog XML files or archives to a bulk format')
+    ap.add_argument('--output', '-o', required=True,
+                    help='Output file: .csv, .jsonl or .npz')
+    ap.add_argument('tasklog', nargs='+')
+    args = ap.parse_args()
+    n = export((ts for f in args.tasklog
+                for ts in Timesheet.iter_tasklog_xml(f)), args.output)
+    print 'wrote %d timesheets to %s' % (n, args.output)
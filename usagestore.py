@@ -0,0 +1,118 @@
+#=======================================================================
+#       Time-series store for broadband usage samples
+#
+# File layout: 16-byte header, then fixed-width little-endian records
+#   time, dsl.tx, dsl.rx, inet.tx, inet.rx   (5 doubles; GB counters)
+# Records are appended in time order, so a time range is found by
+# binary search.  Writers hold an exclusive flock on the file while they
+# append.  Queries need numpy; appending does not.
+#=======================================================================
+import fcntl
+import os
+import struct
+import time
+
+MAGIC = 'BBUSAGE1'
+HEADER = MAGIC + '\0' * 8
+FIELDS = ('dsl_tx', 'dsl_rx', 'inet_tx', 'inet_rx')
+RECORD = struct.Struct('<5d')
+
+class UsageStore(object):
+    '''Append-only file of Modem.get_broadband_usage() samples'''
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if not os.path.exists(self.path):
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, 'wb') as f:
+                f.write(HEADER)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a usage store' % self.path)
+
+    def __len__(self):
+        size = os.path.getsize(self.path) - len(HEADER)
+        return size // RECORD.size
+
+    def append(self, usage, t=None):
+        '''Add a sample, e.g. {'dsl': {'tx': 1.5, 'rx': 20.1}, 'inet': {...}}
+        :param t: Sample time in seconds since the epoch; default now
+        '''
+        values = [usage[net][key]
+                  for net, key in (f.split('_') for f in FIELDS)]
+        with open(self.path, 'r+b') as f:
+            # Other processes (cron, a poller) may append at the same time
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if t is None:
+                t = time.time()
+            size = os.fstat(f.fileno()).st_size - len(HEADER)
+            n = size // RECORD.size
+            if n and t < self._time_at(f, n - 1):
+                raise ValueError('Sample at %s is older than the last one'
+                                 % t)
+            # Drop any partial record left by an interrupted write
+            f.truncate(len(HEADER) + n * RECORD.size)
+            f.seek(0, os.SEEK_END)
+            f.write(RECORD.pack(t, *values))
+
+    def _time_at(self, f, i):
+        f.seek(len(HEADER) + i * RECORD.size)
+        return struct.unpack('<d', f.read(8))[0]
+
+    def read(self, start=None, end=None):
+        '''Samples with start <= time < end as a numpy record array
+        with fields t, dsl_tx, dsl_rx, inet_tx, inet_rx'''
+        import numpy as np
+        dtype = np.dtype([('t', '<f8')] + [(f, '<f8') for f in FIELDS])
+        n = len(self)
+        if n == 0:
+            return np.zeros(0, dtype)
+        data = np.memmap(self.path, dtype, mode='r', offset=len(HEADER),
+                         shape=(n,))
+        times = data['t']
+        lo = 0 if start is None else np.searchsorted(times, start, 'left')
+        hi = n if end is None else np.searchsorted(times, end, 'left')
+        return np.array(data[lo:hi])
+
+    def deltas(self, start=None, end=None):
+        '''Traffic between consecutive samples.
+        A counter lower than the previous sample means the modem restarted
+        its counters, so the whole new value counts as traffic.
+        Return (times, dt, deltas) where deltas has a column per field.
+        '''
+        import numpy as np
+        data = self.read(start, end)
+        counters = np.column_stack([data[f] for f in FIELDS])
+        diff = np.diff(counters, axis=0)
+        diff = np.where(diff < 0, counters[1:], diff)
+        return data['t'][1:], np.diff(data['t']), diff
+
+    def rates(self, start=None, end=None):
+        '''Throughput in GB/s over each interval between samples.
+        Return (times, rates) where rates has a column per field.
+        '''
+        import numpy as np
+        times, dt, diff = self.deltas(start, end)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(dt[:, None] > 0, diff / dt[:, None], 0.0)
+        return times, rates
+
+    def rollup(self, step, start=None, end=None):
+        '''Traffic per step-second bucket.
+        Return (bucket start times, totals, mean rates in GB/s), with a
+        column per field in totals and rates.
+        '''
+        import numpy as np
+        times, dt, diff = self.deltas(start, end)
+        if len(times) == 0:
+            empty = np.zeros((0, len(FIELDS)))
+            return np.zeros(0), empty, empty
+        buckets = np.floor(times / step) * step
+        starts, index = np.unique(buckets, return_index=True)
+        totals = np.add.reduceat(diff, index, axis=0)
+        spans = np.add.reduceat(dt, index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(spans[:, None] > 0, totals / spans[:, None], 0.0)
+        return starts, totals, rates